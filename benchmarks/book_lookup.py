@@ -0,0 +1,56 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from opening_book import PlayerBook, _read_book
+
+
+# Microbenchmark of PlayerBook lookups by Zobrist key: keys found in the book
+# and random keys that miss, looked up one by one without and with the LRU
+# cache, and in batches
+def benchmark_lookups(book_file, num_of_lookups=100000, seed=0):
+    rng = random.Random(seed)
+    book_keys = sorted({key for key, _, _ in _read_book(book_file)})
+    keys = [
+        rng.choice(book_keys) if book_keys and rng.random() < 0.5 else rng.getrandbits(64)
+        for _ in range(num_of_lookups)
+    ]
+
+    results = {"book_entries": os.path.getsize(book_file) // 16, "lookups": num_of_lookups}
+    with PlayerBook(book_file, cache_size=0) as book:
+        start = time.perf_counter()
+        for key in keys:
+            book.find_entries(key)
+        results["uncached_us"] = (time.perf_counter() - start) / num_of_lookups * 1e6
+
+        start = time.perf_counter()
+        book.find_entries_many(keys)
+        results["batch_us"] = (time.perf_counter() - start) / num_of_lookups * 1e6
+
+    with PlayerBook(book_file) as book:
+        hot_keys = keys[:1000]
+        for key in hot_keys:
+            book.find_entries(key)
+        start = time.perf_counter()
+        for i in range(num_of_lookups):
+            book.find_entries(hot_keys[i % len(hot_keys)])
+        results["cached_us"] = (time.perf_counter() - start) / num_of_lookups * 1e6
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the lookup latency of a polyglot book")
+    parser.add_argument("book_file", type=str, help="The path to the polyglot book")
+    parser.add_argument("--lookups", type=int, default=100000, help="Number of lookups to time")
+    args = parser.parse_args()
+
+    results = benchmark_lookups(args.book_file, args.lookups)
+    print(f"Book entries: {results['book_entries']}")
+    print(f"Uncached lookup: {results['uncached_us']:.2f} us")
+    print(f"Batched lookup: {results['batch_us']:.2f} us")
+    print(f"Cached lookup: {results['cached_us']:.2f} us")
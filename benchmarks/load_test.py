@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.request
+
+import chess.pgn
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+from move_server import MovePredictor, load_model
+from opening_book import PlayerBook
+from profiler import StageStats
+
+
+DEFAULT_PGN = os.path.join(REPO_DIR, "Adam05.pgn")
+
+
+# FENs of num_of_positions positions picked at random from the games of a
+# PGN file, with the player to move
+def sample_positions(pgn_file, num_of_positions, seed=0):
+    fens = []
+    with open(pgn_file) as pgn:
+        while True:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            board = game.board()
+            for move in game.mainline_moves():
+                if not board.is_game_over():
+                    fens.append(board.fen())
+                board.push(move)
+    rng = random.Random(seed)
+    return [rng.choice(fens) for _ in range(num_of_positions)]
+
+
+# Send every FEN once, spread over clients threads, timing each request.
+# Requests go to a move server at url, or to predictor in this process.
+def run_load(fens, clients, url=None, predictor=None):
+    latency = StageStats()
+    sources = {}
+    lock = threading.Lock()
+    next_fen = iter(fens)
+
+    def client():
+        while True:
+            with lock:
+                fen = next(next_fen, None)
+            if fen is None:
+                return
+
+            start = time.perf_counter_ns()
+            if url is not None:
+                request = urllib.request.Request(
+                    url + "/move",
+                    data=json.dumps({"fen": fen}).encode(),
+                    headers={"Content-Type": "application/json"},
+                )
+                with urllib.request.urlopen(request) as response:
+                    source = json.load(response)["source"]
+            else:
+                source, _ = predictor.predict(chess.Board(fen))
+            elapsed_ns = time.perf_counter_ns() - start
+
+            with lock:
+                latency.add(elapsed_ns)
+                sources[source] = sources.get(source, 0) + 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_sec = time.perf_counter() - start
+
+    return {
+        "requests": latency.calls,
+        "clients": clients,
+        "wall_sec": wall_sec,
+        "throughput_per_sec": latency.calls / wall_sec,
+        "mean_ms": latency.total_ns / latency.calls / 1e6,
+        "p50_ms": latency.percentile_ns(0.5) / 1e6,
+        "p99_ms": latency.percentile_ns(0.99) / 1e6,
+        "max_ms": latency.max_ns / 1e6,
+        "sources": sources,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load test the move server with positions from a PGN file and report "
+        "throughput and latency percentiles"
+    )
+    parser.add_argument("--url", type=str, help="Base URL of a running move server (e.g. http://127.0.0.1:8000)")
+    parser.add_argument("--model", type=str, help="The path to the JSON model, to test in process instead of over HTTP")
+    parser.add_argument("--book", type=str, help="The player's polyglot book, with --model")
+    parser.add_argument("--pgn", type=str, default=DEFAULT_PGN, help="The PGN file to take positions from")
+    parser.add_argument("--requests", type=int, default=2000, help="Number of requests to send")
+    parser.add_argument("--clients", type=int, default=4, help="Number of concurrent clients")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the position sample")
+    parser.add_argument(
+        "--target-p99-ms",
+        type=float,
+        default=50.0,
+        help="p99 latency to meet, exiting with status 1 when exceeded (default 50 ms)",
+    )
+    parser.add_argument("--output", type=str, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if (args.url is None) == (args.model is None):
+        parser.error("give either --url or --model")
+
+    fens = sample_positions(args.pgn, args.requests, args.seed)
+    if args.url is not None:
+        results = run_load(fens, args.clients, url=args.url.rstrip("/"))
+    else:
+        book = PlayerBook(args.book) if args.book else None
+        try:
+            results = run_load(fens, args.clients, predictor=MovePredictor(load_model(args.model), book))
+        finally:
+            if book is not None:
+                book.close()
+
+    print(f"Requests: {results['requests']} from {results['clients']} clients in {results['wall_sec']:.2f} s")
+    print(f"Throughput: {results['throughput_per_sec']:.1f} requests/s")
+    print(
+        f"Latency: mean {results['mean_ms']:.2f} ms, p50 {results['p50_ms']:.2f} ms, "
+        f"p99 {results['p99_ms']:.2f} ms, max {results['max_ms']:.2f} ms"
+    )
+    print("Sources: " + ", ".join(f"{source} {count}" for source, count in sorted(results["sources"].items())))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if results["p99_ms"] > args.target_p99_ms:
+        print(f"p99 latency above the {args.target_p99_ms} ms target", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,349 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import chess
+import chess.pgn
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+import extract_features
+from book_lookup import benchmark_lookups
+from extract_features import FEATURES, AttackMap, extract_after_move, extract_all
+from main import FeatureRowWriter, process_game, process_pgn
+from opening_book import OpeningBookBuilder
+
+
+DEFAULT_PGN = os.path.join(REPO_DIR, "Adam05.pgn")
+
+
+# Functions timed one by one, with (board, is_white) arguments, and whether
+# they look pawn structures up in the pawn hash table: every registered
+# feature computed alone by extract_all, including the intermediates it
+# requires, then the attack map and all features at once
+def feature_functions():
+    functions = [
+        (
+            name,
+            lambda board, is_white, name=name: extract_all(board, is_white, features=[name]),
+            "pawn_entry" in feature.requires,
+        )
+        for name, feature in FEATURES.items()
+    ]
+    functions.append(("attack_map", lambda board, is_white: AttackMap(board), False))
+    functions.append(("extract_all", extract_all, True))
+    return functions
+
+
+# Empty the pawn hash table of extract_features, which otherwise keeps the
+# pawn structures of every position timed before
+def clear_pawn_table():
+    extract_features._pawn_table[:] = [None] * extract_features.PAWN_TABLE_SIZE
+
+
+POSITION_BUCKETS = ["opening", "middlegame", "endgame"]
+
+
+# Game phase of a position: the first 20 plies are the opening, positions
+# with at most 13 points of non-pawn material left per side on average
+# (26 in total) are the endgame
+def position_bucket(board, ply):
+    if ply <= 20:
+        return "opening"
+    material = (
+        3 * chess.popcount(board.knights | board.bishops)
+        + 5 * chess.popcount(board.rooks)
+        + 9 * chess.popcount(board.queens)
+    )
+    return "endgame" if material <= 26 else "middlegame"
+
+
+# A fixed, seeded sample of positions of every bucket from a PGN file
+def load_positions(pgn_file, per_bucket=200, seed=0):
+    buckets = {bucket: [] for bucket in POSITION_BUCKETS}
+    with open(pgn_file) as pgn:
+        while True:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            board = game.board()
+            for ply, move in enumerate(game.mainline_moves(), start=1):
+                buckets[position_bucket(board, ply)].append((board.copy(stack=False), board.turn))
+                board.push(move)
+
+    rng = random.Random(seed)
+    return {
+        bucket: rng.sample(positions, min(per_bucket, len(positions)))
+        for bucket, positions in buckets.items()
+    }
+
+
+# Seconds per call of function over the positions, going over them as
+# many times as needed to last at least min_time seconds. before_pass, if
+# given, is called untimed before every pass over the positions. As in
+# timeit, the garbage collector is off while timing, as its pauses depend
+# on everything allocated before.
+def time_per_call(function, positions, min_time=0.05, before_pass=None):
+    num_of_calls = 0
+    elapsed = 0.0
+    gc.disable()
+    try:
+        while True:
+            if before_pass is not None:
+                before_pass()
+            start = time.perf_counter()
+            for board, is_white in positions:
+                function(board, is_white)
+            elapsed += time.perf_counter() - start
+            num_of_calls += len(positions)
+            if elapsed >= min_time:
+                return elapsed / num_of_calls
+    finally:
+        gc.enable()
+
+
+# Shortest of the times of several rounds, and how much slower the slowest
+# round is than it, as a ratio
+def best_and_noise(times):
+    best = min(times)
+    return best, (max(times) - best) / best
+
+
+# Child features of every legal move of a position
+def after_moves(board, is_white):
+    attack_map = AttackMap(board)
+    parent = extract_all(board, is_white, attack_map)
+    for move in attack_map.legal_moves:
+        extract_after_move(board, move, is_white, parent, attack_map=attack_map)
+
+
+# Microseconds per call of every feature function by game phase, the best
+# of `repeat` rounds, and the noise of each of these metrics (see
+# best_and_noise). Every round times every function once, so that a slow
+# spell of the machine affects one round of many metrics rather than all
+# rounds of a few.
+#
+# The pawn hash table is emptied before every pass over the positions, so
+# that the <bucket>_us metrics compute every pawn structure of the sample
+# at least once, as a real extraction does. Functions that use the table are
+# also timed with every pawn structure of the sample already in it, as
+# <bucket>_warm_us metrics.
+def benchmark_features(positions, repeat=5, min_time=0.05):
+    times = {}
+    for _ in range(repeat):
+        for bucket, bucket_positions in positions.items():
+            for name, function, uses_pawn_table in feature_functions():
+                times.setdefault(f"feature.{name}.{bucket}_us", []).append(
+                    time_per_call(function, bucket_positions, min_time, clear_pawn_table)
+                )
+                if uses_pawn_table:
+                    times.setdefault(f"feature.{name}.{bucket}_warm_us", []).append(
+                        time_per_call(function, bucket_positions, min_time)
+                    )
+
+            # Per move rather than per position
+            num_of_moves = sum(board.legal_moves.count() for board, _ in bucket_positions)
+            for suffix, before_pass in (("us", clear_pawn_table), ("warm_us", None)):
+                per_position = time_per_call(after_moves, bucket_positions, min_time, before_pass)
+                times.setdefault(f"feature.extract_after_move.{bucket}_{suffix}", []).append(
+                    per_position * len(bucket_positions) / max(1, num_of_moves)
+                )
+
+    results = {}
+    noise = {}
+    for metric, metric_times in times.items():
+        best, noise[metric] = best_and_noise(metric_times)
+        results[metric] = best * 1e6
+    return results, noise
+
+
+class NullWriter:
+    def writerow(self, row):
+        pass
+
+
+# Throughput of the main.py feature loop, without the cost of writing rows,
+# the best of `repeat` rounds, and the noise of these metrics
+def benchmark_extraction(pgn_file, max_games=100, repeat=5):
+    with open(pgn_file) as pgn:
+        games = []
+        while len(games) < max_games:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            games.append(game)
+
+    times = []
+    parse_times = []
+    for _ in range(repeat):
+        # Every round starts from an empty pawn hash table, as a real run does
+        clear_pawn_table()
+        row_writer = FeatureRowWriter(NullWriter(), "")
+        start = time.perf_counter()
+        for game in games:
+            process_game(game, [row_writer])
+        elapsed = time.perf_counter() - start
+
+        # Parsing included, as in a real run
+        start = time.perf_counter()
+        with open(pgn_file) as pgn:
+            num_of_parsed = 0
+            while num_of_parsed < len(games) and chess.pgn.read_game(pgn) is not None:
+                num_of_parsed += 1
+        parse_elapsed = time.perf_counter() - start
+
+        times.append(elapsed + parse_elapsed)
+        parse_times.append(parse_elapsed)
+
+    elapsed, noise = best_and_noise(times)
+    parse_elapsed, parse_noise = best_and_noise(parse_times)
+    results = {
+        "extraction.games_per_sec": len(games) / elapsed,
+        "extraction.rows_per_sec": row_writer.num_of_rows / elapsed,
+        "extraction.parse_games_per_sec": len(games) / parse_elapsed,
+    }
+    return results, {
+        "extraction.games_per_sec": noise,
+        "extraction.rows_per_sec": noise,
+        "extraction.parse_games_per_sec": parse_noise,
+    }
+
+
+# Build the player's opening book, without printing where it was written
+def build_book(pgn_file, player_name, output_book):
+    book_builder = OpeningBookBuilder(player_name)
+    with open(pgn_file) as pgn:
+        process_pgn(pgn, [book_builder])
+    with contextlib.redirect_stdout(io.StringIO()):
+        book_builder.write(output_book)
+
+
+# Time of building the player's opening book and of looking positions up
+# in it, the best of `repeat` rounds, and the noise of these metrics. The
+# peak traced memory is measured in a separate build, as tracing slows the
+# build down.
+def benchmark_book(pgn_file, player_name, repeat=5):
+    with tempfile.TemporaryDirectory() as directory:
+        output_book = os.path.join(directory, "book.bin")
+        tracemalloc.start()
+        build_book(pgn_file, player_name, output_book)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        times = {"book.build_sec": []}
+        for _ in range(repeat):
+            start = time.perf_counter()
+            build_book(pgn_file, player_name, output_book)
+            times["book.build_sec"].append(time.perf_counter() - start)
+
+            lookups = benchmark_lookups(output_book, num_of_lookups=20000)
+            for kind in ("uncached", "batch", "cached"):
+                times.setdefault(f"book.lookup_{kind}_us", []).append(lookups[f"{kind}_us"])
+
+    results = {"book.peak_memory_mb": peak / (1 << 20)}
+    noise = {}
+    for metric, metric_times in times.items():
+        results[metric], noise[metric] = best_and_noise(metric_times)
+    return results, noise
+
+
+# Metrics where a higher value is better; every other metric is a time or
+# a memory size where lower is better
+def higher_is_better(metric):
+    return metric.endswith("_per_sec")
+
+
+# Metrics that got worse than the baseline by more than threshold (a ratio)
+# plus the noise measured for the metric in both runs, so that metrics that
+# vary a lot from run to run need a larger change to count as a regression
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for metric, value in results["metrics"].items():
+        base_value = baseline["metrics"].get(metric)
+        if not base_value:
+            continue
+        if higher_is_better(metric):
+            change = (base_value - value) / base_value
+        else:
+            change = (value - base_value) / base_value
+        noise = results.get("noise", {}).get(metric, 0.0) + baseline.get("noise", {}).get(metric, 0.0)
+        if change > threshold + noise:
+            regressions.append((metric, base_value, value, change))
+    return regressions
+
+
+def run_benchmarks(pgn_file, per_bucket=200, max_games=100, seed=0, repeat=5, min_time=0.05):
+    player_name = os.path.splitext(os.path.basename(pgn_file))[0]
+    positions = load_positions(pgn_file, per_bucket, seed)
+
+    metrics = {}
+    noise = {}
+    for benchmark_metrics, benchmark_noise in (
+        benchmark_features(positions, repeat, min_time),
+        benchmark_extraction(pgn_file, max_games, repeat),
+        benchmark_book(pgn_file, player_name, repeat),
+    ):
+        metrics.update(benchmark_metrics)
+        noise.update(benchmark_noise)
+
+    return {
+        "pgn_file": os.path.basename(pgn_file),
+        "seed": seed,
+        "positions_per_bucket": {bucket: len(boards) for bucket, boards in positions.items()},
+        "python": platform.python_version(),
+        "chess": chess.__version__,
+        "metrics": metrics,
+        "noise": noise,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the feature functions, the extraction loop and book building")
+    parser.add_argument("--pgn", type=str, default=DEFAULT_PGN, help="The PGN file positions are drawn from")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file")
+    parser.add_argument("--compare", type=str, help="JSON results of an earlier run to check for regressions")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown that counts as a regression, on top of the measured noise (default 0.1 = 10%%)",
+    )
+    parser.add_argument("--positions", type=int, default=200, help="Positions per game phase")
+    parser.add_argument("--games", type=int, default=100, help="Games for the end-to-end benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the position sample")
+    parser.add_argument("--repeat", type=int, default=5, help="Rounds of every benchmark, the best of each is kept")
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.05,
+        help="Minimum duration in seconds of each microbenchmark in a round (default 0.05)",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.pgn, args.positions, args.games, args.seed, args.repeat, args.min_time)
+    for metric, value in sorted(results["metrics"].items()):
+        print(f"{metric:55} {value:12.2f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for metric, base_value, value, change in regressions:
+            print(f"REGRESSION {metric}: {base_value:.2f} -> {value:.2f} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
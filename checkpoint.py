@@ -0,0 +1,129 @@
+import json
+import os
+
+
+# Files kept next to the output file
+def checkpoint_file_for(output_file):
+    return output_file + ".ckpt"
+
+
+def processed_ids_file_for(output_file):
+    return output_file + ".done"
+
+
+def book_runs_dir_for(output_file):
+    return output_file + ".runs"
+
+
+def load_checkpoint(output_file):
+    checkpoint_file = checkpoint_file_for(output_file)
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+
+# Site headers of the games already extracted to output_file
+def load_processed_ids(output_file):
+    processed_ids_file = processed_ids_file_for(output_file)
+    if not os.path.exists(processed_ids_file):
+        return set()
+    with open(processed_ids_file) as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+# Keeps track of an extraction so that it can be resumed after a crash.
+# A checkpoint is saved when the run begins and then every `every` games:
+# the output is flushed, the opening book counts are merged with the
+# earlier ones into a single run file and the PGN position, game and row
+# counts, output size and book run are saved to <output>.ckpt. When
+# record_ids is set the Site header of every extracted game is appended to
+# <output>.done at each checkpoint, for incremental runs to skip.
+class Checkpointer:
+    def __init__(
+        self,
+        output_file,
+        output,
+        book_builder,
+        every=0,
+        record_ids=False,
+        checkpoint=None,
+        skipped=0,
+    ):
+        self.output_file = output_file
+        self.output = output
+        self.book_builder = book_builder
+        self.every = every
+        self.record_ids = record_ids
+        self.pending_ids = []
+
+        # Counts of earlier runs on the same output, and the number of
+        # selected games the resumed run skips
+        self.base_games = 0
+        self.base_rows = 0
+        self.skipped = skipped
+        self.games_in_run = 0
+        if checkpoint is not None:
+            self.base_games = checkpoint["games"]
+            self.base_rows = checkpoint["rows"]
+            book_builder.run_files = list(checkpoint["book_runs"])
+
+        if every:
+            os.makedirs(book_runs_dir_for(output_file), exist_ok=True)
+            book_builder.run_dir = book_runs_dir_for(output_file)
+
+    # Called after every game with the PGN handle positioned after it and
+    # the number of rows written so far in this run
+    def game_done(self, pgn, game, rows_in_run):
+        self.games_in_run += 1
+        if self.record_ids:
+            self.pending_ids.append(game.headers.get("Site", ""))
+
+        if self.every and self.games_in_run % self.every == 0:
+            self.save(pgn.tell(), rows_in_run)
+
+    # Save a checkpoint of the output as it is before the run adds any game,
+    # so that a run that crashes before its first checkpoint is resumed by
+    # truncating what it appended rather than appending its games again
+    def begin(self):
+        self.save(0, 0)
+
+    def save(self, pgn_offset, rows_in_run):
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        self.book_builder.spill()
+        replaced_runs = self.book_builder.compact_runs()
+        self.write_processed_ids()
+
+        checkpoint = {
+            "pgn_offset": pgn_offset,
+            "games": self.base_games + self.games_in_run,
+            "rows": self.base_rows + rows_in_run,
+            "selection_done": self.skipped + self.games_in_run,
+            "output_size": os.fstat(self.output.fileno()).st_size,
+            "book_runs": self.book_builder.run_files,
+        }
+        checkpoint_file = checkpoint_file_for(self.output_file)
+        with open(checkpoint_file + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+        # The runs merged into the new one are no longer listed anywhere
+        for path in replaced_runs:
+            os.remove(path)
+
+    def write_processed_ids(self):
+        if self.pending_ids:
+            with open(processed_ids_file_for(self.output_file), "a") as f:
+                f.writelines(site + "\n" for site in self.pending_ids)
+            self.pending_ids = []
+
+    # Record the last games and drop the checkpoint once the run completed
+    def finish(self):
+        self.write_processed_ids()
+        checkpoint_file = checkpoint_file_for(self.output_file)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        runs_dir = book_runs_dir_for(self.output_file)
+        if os.path.isdir(runs_dir) and not os.listdir(runs_dir):
+            os.rmdir(runs_dir)
@@ -0,0 +1,157 @@
+import array
+import json
+import os
+import sys
+
+import chess
+
+from extract_features import FEATURE_NAMES
+
+
+# Features whose values can exceed the int8 range
+WIDE_FEATURES = {
+    "white_material_balance",
+    "black_material_balance",
+    "material_imbalance",
+    "white_piece_mobility",
+    "black_piece_mobility",
+}
+
+
+# Typecode of the array module and numpy dtype of every column: int16 for
+# the wide features, int8 for every other feature
+def column_types(feature_columns, sample_weight=False):
+    return (
+        [("is_white_player", "B", "u1"), ("position", "i", "i4"), ("move", "H", "u2")]
+        + [
+            (name, "h", "i2") if name in WIDE_FEATURES else (name, "b", "i1")
+            for name in feature_columns
+        ]
+        + [("label", "B", "u1")]
+        + ([("sample_weight", "f", "f4")] if sample_weight else [])
+    )
+
+
+# Every column file starts with a fixed-size .npy header so that the row
+# count can be filled in once the file is complete
+NPY_HEADER_SIZE = 128
+BYTE_ORDER = "<" if sys.byteorder == "little" else ">"
+
+SCHEMA_FILE = "schema.json"
+POSITIONS_FILE = "positions.txt"
+
+
+# Encode a move into 16 bits: from square, to square and promotion piece type
+def encode_move(move):
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+
+def decode_move(encoded):
+    promotion = encoded >> 12
+    return chess.Move(encoded & 63, (encoded >> 6) & 63, promotion or None)
+
+
+def _npy_header(dtype, num_rows):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+        dtype,
+        num_rows,
+    )
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+
+# Writes feature rows as one fixed-width .npy file per column in a directory,
+# which numpy can memory-map without parsing. The FEN of every position is
+# written once to positions.txt and rows refer to it by line number in the
+# position column. Accepts the same rows as the CSV writer, with the given
+# feature columns and, with sample_weight set, a trailing sample weight.
+class ColumnarWriter:
+    def __init__(
+        self, directory, buffer_rows=65536, feature_columns=FEATURE_NAMES, sample_weight=False
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.buffer_rows = buffer_rows
+        self.column_types = column_types(feature_columns, sample_weight)
+        self.num_of_features = len(feature_columns)
+        self.num_of_rows = 0
+        self.num_of_positions = 0
+        self.last_fen = None
+
+        self.columns = []
+        for name, typecode, dtype in self.column_types:
+            column_file = open(os.path.join(directory, f"{name}.npy"), "wb")
+            column_file.write(_npy_header(BYTE_ORDER + dtype, 0))
+            self.columns.append((column_file, array.array(typecode), dtype))
+        self.positions_file = open(os.path.join(directory, POSITIONS_FILE), "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def writerow(self, row):
+        is_white, fen, uci_move = row[0], row[1], row[2]
+
+        # Rows of the same position are written one after another
+        if fen != self.last_fen:
+            self.positions_file.write(fen + "\n")
+            self.num_of_positions += 1
+            self.last_fen = fen
+
+        features_end = 3 + self.num_of_features
+        values = (
+            [is_white, self.num_of_positions - 1, encode_move(chess.Move.from_uci(uci_move))]
+            + [int(value) for value in row[3:features_end]]
+            + row[features_end:]
+        )
+        for (_, buffer, _), value in zip(self.columns, values):
+            buffer.append(value)
+
+        self.num_of_rows += 1
+        if len(self.columns[0][1]) >= self.buffer_rows:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        for column_file, buffer, _ in self.columns:
+            buffer.tofile(column_file)
+            del buffer[:]
+
+    def close(self):
+        self.flush()
+        for column_file, _, dtype in self.columns:
+            column_file.seek(0)
+            column_file.write(_npy_header(BYTE_ORDER + dtype, self.num_of_rows))
+            column_file.close()
+        self.positions_file.close()
+
+        schema = {
+            "num_rows": self.num_of_rows,
+            "num_positions": self.num_of_positions,
+            "columns": [
+                {"name": name, "dtype": BYTE_ORDER + dtype, "file": f"{name}.npy"}
+                for name, _, dtype in self.column_types
+            ],
+            "positions_file": POSITIONS_FILE,
+            "move_encoding": "from_square | to_square << 6 | promotion_piece_type << 12",
+        }
+        with open(os.path.join(self.directory, SCHEMA_FILE), "w") as f:
+            json.dump(schema, f, indent=2)
+
+
+# Memory-map every column of a columnar output directory. Needs numpy (see
+# requirements-optional.txt).
+def load_columnar(directory):
+    import numpy as np
+
+    with open(os.path.join(directory, SCHEMA_FILE)) as f:
+        schema = json.load(f)
+    return {
+        column["name"]: np.load(os.path.join(directory, column["file"]), mmap_mode="r")
+        for column in schema["columns"]
+    }
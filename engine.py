@@ -0,0 +1,507 @@
+import argparse
+import json
+import sys
+import threading
+import time
+
+import chess
+import chess.polyglot
+
+from extract_features import (
+    FEATURE_NAMES,
+    FEATURES,
+    AttackMap,
+    extract_all,
+    feature_columns,
+    required_intermediates,
+)
+from uci_position import board_from_uci_position
+
+
+MATE_SCORE = 100000
+MAX_PLY = 64
+
+# Piece values by piece type for MVV-LVA ordering of captures
+ORDER_VALUES = [0, 1, 3, 3, 5, 9, 20]
+
+# Columns computed for the player given to extract_all rather than for a
+# fixed color. They are evaluated as the difference between White's and
+# Black's value.
+PLAYER_COLUMNS = {
+    "center_control",
+    "player_space_advantage",
+    "player_knight_outposts",
+    "player_passed_pawn_advancement",
+}
+
+# Evaluation weights in centipawns from White's point of view: black
+# columns get negative weights, player columns weigh White's value minus
+# Black's. Columns left out are not computed. rook_on_seventh_rank and
+# player_space_advantage only count for White, and piece_mobility only for
+# the side to move, so they would skew the evaluation and are left out.
+# white_king_castled and black_king_castled are 1 while the side still has
+# castling rights, which castling gives up, so a weight on them would steer
+# the search away from castling; they are left out too.
+EVAL_WEIGHTS = {
+    "white_material_balance": 100,
+    "black_material_balance": -100,
+    "white_bishop_pair": 30,
+    "black_bishop_pair": -30,
+    "white_attacking_pieces": -10,
+    "black_attacking_pieces": 10,
+    "white_hanging_pieces": -15,
+    "black_hanging_pieces": 15,
+    "white_semi_open_files": 5,
+    "black_semi_open_files": -5,
+    "center_control": 8,
+    "player_knight_outposts": 15,
+    "player_passed_pawn_advancement": 6,
+}
+
+# Transposition table entry bounds
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+
+# Positions searched by the benchmark: the starting position, open and
+# closed middlegames and endgames
+BENCH_POSITIONS = [
+    chess.STARTING_FEN,
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP1B1PPP/R2QKB1R w KQ - 0 8",
+    "r2q1rk1/1b1nbppp/p2ppn2/1p6/3NPP2/1BN1B3/PPP1Q1PP/2KR3R w - - 0 12",
+    "rnbqkb1r/pp3ppp/4pn2/2pp4/3P4/2PBPN2/PP3PPP/RNBQK2R b KQkq - 0 5",
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    "6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1",
+    "8/8/4k3/3p4/3P4/4K3/8/8 w - - 0 1",
+]
+
+
+# Weighted combination of the extract_features columns. Only the features
+# of weighted columns are computed, sharing one AttackMap built from the
+# legal moves the search already generated.
+class Evaluator:
+    def __init__(self, weights=EVAL_WEIGHTS):
+        unknown = set(weights) - set(FEATURE_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown evaluation columns: {', '.join(sorted(unknown))}")
+
+        self.features = [
+            name
+            for name, feature in FEATURES.items()
+            if any(weights.get(column) for column in feature.columns)
+        ]
+        columns = [column for column in feature_columns(self.features) if weights.get(column)]
+        self.weights = [(column, weights[column]) for column in columns if column not in PLAYER_COLUMNS]
+        self.player_weights = [(column, weights[column]) for column in columns if column in PLAYER_COLUMNS]
+        self.player_features = [
+            name
+            for name in self.features
+            if any(column in PLAYER_COLUMNS for column in FEATURES[name].columns)
+        ]
+        self.uses_attack_map = "attack_map" in required_intermediates(self.features)
+
+    # Score of the position for the side to move, in centipawns
+    def evaluate(self, board, legal_moves):
+        attack_map = AttackMap(board, legal_moves) if self.uses_attack_map else None
+        values = extract_all(board, True, attack_map, self.features)
+        score = 0
+        for column, weight in self.weights:
+            score += weight * values[column]
+        if self.player_weights:
+            black_values = extract_all(board, False, attack_map, self.player_features)
+            for column, weight in self.player_weights:
+                score += weight * (values[column] - black_values[column])
+        score = int(round(score))
+        return score if board.turn else -score
+
+
+def load_weights(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# Mate scores are stored relative to the node rather than to the root
+def _score_to_table(score, ply):
+    if score > MATE_SCORE - MAX_PLY * 2:
+        return score + ply
+    if score < -MATE_SCORE + MAX_PLY * 2:
+        return score - ply
+    return score
+
+
+def _score_from_table(score, ply):
+    if score > MATE_SCORE - MAX_PLY * 2:
+        return score - ply
+    if score < -MATE_SCORE + MAX_PLY * 2:
+        return score + ply
+    return score
+
+
+class SearchStopped(Exception):
+    pass
+
+
+# Search time for a move from the UCI clock: a share of the remaining
+# time plus most of the increment, or movetime. None when unlimited.
+def time_budget(board, wtime=None, btime=None, winc=0, binc=0, movestogo=None, movetime=None):
+    if movetime is not None:
+        return movetime / 1000
+    remaining = wtime if board.turn else btime
+    if remaining is None:
+        return None
+    increment = winc if board.turn else binc
+    budget = remaining / (movestogo or 30) + increment * 0.75
+    return max(0.01, min(budget, remaining * 0.5 - 50) / 1000)
+
+
+# Iterative-deepening alpha-beta search with quiescence search on
+# captures. Positions are stored in a direct-mapped, always-replace
+# transposition table keyed by Zobrist hash. Moves are ordered by the
+# table's move, captures by MVV-LVA, killer moves and the history score.
+class Search:
+    def __init__(self, evaluator, hash_size=1 << 18):
+        self.evaluator = evaluator
+        self.hash_size = hash_size
+        self.table = [None] * hash_size
+        self.stop_event = threading.Event()
+        self.history = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.nodes = 0
+        self.evaluations = 0
+        self.evaluation_ns = 0
+
+    def clear(self):
+        self.table = [None] * self.hash_size
+        self.history = {}
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _check_limits(self):
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchStopped
+        if self.nodes & 1023 == 0 and (
+            self.stop_event.is_set()
+            or (self.deadline is not None and time.perf_counter() >= self.deadline)
+        ):
+            raise SearchStopped
+
+    def _evaluate(self, board, legal_moves):
+        start = time.perf_counter_ns()
+        score = self.evaluator.evaluate(board, legal_moves)
+        self.evaluation_ns += time.perf_counter_ns() - start
+        self.evaluations += 1
+        return score
+
+    def _order_moves(self, board, moves, table_move, ply):
+        killers = self.killers[ply]
+        history = self.history
+
+        def order(move):
+            if move == table_move:
+                return 1 << 30
+            if board.is_capture(move):
+                victim = board.piece_type_at(move.to_square) or chess.PAWN
+                return (1 << 20) + ORDER_VALUES[victim] * 32 - ORDER_VALUES[board.piece_type_at(move.from_square)]
+            if move.promotion:
+                return (1 << 20) + ORDER_VALUES[move.promotion] * 32
+            if move in killers:
+                return (1 << 19) - killers.index(move)
+            return min(history.get((board.turn, move.from_square, move.to_square), 0), (1 << 19) - 2)
+
+        moves.sort(key=order, reverse=True)
+        return moves
+
+    def _quiesce(self, board, alpha, beta, ply):
+        self.nodes += 1
+        self._check_limits()
+
+        legal_moves = list(board.legal_moves)
+        in_check = board.is_check()
+        if not legal_moves:
+            return -MATE_SCORE + ply if in_check else 0
+        if ply >= MAX_PLY:
+            return self._evaluate(board, legal_moves)
+
+        # Out of check, the side to move can stand pat instead of capturing
+        if in_check:
+            moves = legal_moves
+        else:
+            stand_pat = self._evaluate(board, legal_moves)
+            if stand_pat >= beta:
+                return stand_pat
+            alpha = max(alpha, stand_pat)
+            moves = [move for move in legal_moves if move.promotion or board.is_capture(move)]
+
+        for move in self._order_moves(board, moves, None, ply):
+            board.push(move)
+            score = -self._quiesce(board, -beta, -alpha, ply + 1)
+            board.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def _search(self, board, depth, alpha, beta, ply):
+        if depth <= 0:
+            return self._quiesce(board, alpha, beta, ply)
+
+        self.nodes += 1
+        self._check_limits()
+        if ply and (board.halfmove_clock >= 100 or board.is_repetition(2)):
+            return 0
+
+        key = chess.polyglot.zobrist_hash(board)
+        slot = key % self.hash_size
+        entry = self.table[slot]
+        table_move = None
+        if entry is not None and entry[0] == key:
+            _, entry_depth, entry_score, bound, table_move = entry
+            if ply and entry_depth >= depth:
+                score = _score_from_table(entry_score, ply)
+                if (
+                    bound == EXACT
+                    or (bound == LOWER_BOUND and score >= beta)
+                    or (bound == UPPER_BOUND and score <= alpha)
+                ):
+                    return score
+
+        moves = list(board.legal_moves)
+        if not moves:
+            return -MATE_SCORE + ply if board.is_check() else 0
+
+        original_alpha = alpha
+        best_score = -MATE_SCORE - 1
+        best_move = None
+        for move in self._order_moves(board, moves, table_move, ply):
+            board.push(move)
+            score = -self._search(board, depth - 1, -beta, -alpha, ply + 1)
+            board.pop()
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if ply == 0:
+                    self.root_move = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not board.is_capture(move) and not move.promotion:
+                    killers = self.killers[ply]
+                    if move not in killers:
+                        killers.insert(0, move)
+                        del killers[2:]
+                    history_key = (board.turn, move.from_square, move.to_square)
+                    self.history[history_key] = self.history.get(history_key, 0) + depth * depth
+                break
+
+        if best_score >= beta:
+            bound = LOWER_BOUND
+        elif best_score > original_alpha:
+            bound = EXACT
+        else:
+            bound = UPPER_BOUND
+        self.table[slot] = (key, depth, _score_to_table(best_score, ply), bound, best_move)
+        return best_score
+
+    # Principal variation, read from the transposition table
+    def principal_variation(self, board, max_length):
+        pv = []
+        board = board.copy()
+        while len(pv) < max_length:
+            key = chess.polyglot.zobrist_hash(board)
+            entry = self.table[key % self.hash_size]
+            if entry is None or entry[0] != key or entry[4] is None or not board.is_legal(entry[4]):
+                break
+            pv.append(entry[4])
+            board.push(entry[4])
+        return pv
+
+    # Search the position to depth, for nodes or for movetime seconds,
+    # whichever comes first, deepening one ply at a time. A new iteration
+    # is not started once half the time is spent. info is called with a
+    # dict after every completed iteration. Returns (best_move, score) of
+    # the last completed iteration.
+    def search(self, board, depth=None, nodes=None, movetime=None, info=None):
+        board = board.copy()
+        self.stop_event.clear()
+        self.node_limit = nodes
+        start = time.perf_counter()
+        self.deadline = start + movetime if movetime is not None else None
+        self.killers = [[] for _ in range(MAX_PLY + 1)]
+
+        best_move = None
+        best_score = 0
+        legal_moves = list(board.legal_moves)
+        if legal_moves:
+            best_move = legal_moves[0]
+
+        for iteration_depth in range(1, (depth or MAX_PLY) + 1):
+            self.root_move = None
+            try:
+                score = self._search(board, iteration_depth, -MATE_SCORE - 1, MATE_SCORE + 1, 0)
+            except SearchStopped:
+                break
+            best_move = self.root_move or best_move
+            best_score = score
+
+            elapsed = time.perf_counter() - start
+            if info is not None:
+                info(
+                    {
+                        "depth": iteration_depth,
+                        "score": score,
+                        "nodes": self.nodes,
+                        "time": elapsed,
+                        "nps": int(self.nodes / elapsed) if elapsed else 0,
+                        "pv": self.principal_variation(board, iteration_depth),
+                    }
+                )
+            if abs(score) > MATE_SCORE - MAX_PLY * 2 or not legal_moves:
+                break
+            if movetime is not None and elapsed >= movetime / 2:
+                break
+        return best_move, best_score
+
+
+def format_score(score):
+    if abs(score) > MATE_SCORE - MAX_PLY * 2:
+        plies = MATE_SCORE - abs(score)
+        return f"mate {(plies + 1) // 2 if score > 0 else -((plies + 1) // 2)}"
+    return f"cp {score}"
+
+
+# Search every benchmark position to depth or for nodes, from an empty
+# transposition table, and report the nodes per second and the share of
+# the time spent in the evaluation
+def run_bench(evaluator, depth=None, nodes=None, hash_size=1 << 18, output=sys.stdout):
+    totals = {"nodes": 0, "evaluations": 0, "evaluation_sec": 0.0, "time_sec": 0.0}
+    output.write(f"{'position':>8} {'move':>6} {'score':>10} {'nodes':>10} {'nps':>8} {'eval %':>7}\n")
+    for index, fen in enumerate(BENCH_POSITIONS):
+        search = Search(evaluator, hash_size)
+        board = chess.Board(fen)
+        start = time.perf_counter()
+        move, score = search.search(board, depth=depth, nodes=nodes)
+        elapsed = time.perf_counter() - start
+
+        totals["nodes"] += search.nodes
+        totals["evaluations"] += search.evaluations
+        totals["evaluation_sec"] += search.evaluation_ns / 1e9
+        totals["time_sec"] += elapsed
+        output.write(
+            f"{index + 1:8d} {move.uci() if move else '-':>6} {format_score(score):>10} {search.nodes:10d} "
+            f"{int(search.nodes / elapsed):8d} {search.evaluation_ns / 1e9 / elapsed * 100:6.1f}%\n"
+        )
+
+    totals["nps"] = int(totals["nodes"] / totals["time_sec"])
+    totals["evaluations_per_sec"] = int(totals["evaluations"] / totals["evaluation_sec"]) if totals["evaluations"] else 0
+    output.write(f"Nodes: {totals['nodes']} in {totals['time_sec']:.2f} s, {totals['nps']} nps\n")
+    output.write(
+        f"Evaluations: {totals['evaluations']}, {totals['evaluations_per_sec']} per second, "
+        f"{totals['evaluation_sec'] / totals['time_sec'] * 100:.1f}% of the time\n"
+    )
+    return totals
+
+
+# UCI engine. Searches run in a thread so that stop is answered while
+# searching.
+def run_uci(search, name, input=sys.stdin, output=sys.stdout):
+    board = chess.Board()
+    searcher = None
+    lock = threading.Lock()
+
+    def send(line):
+        with lock:
+            output.write(line + "\n")
+            output.flush()
+
+    def send_info(info):
+        pv = " ".join(move.uci() for move in info["pv"])
+        send(
+            f"info depth {info['depth']} score {format_score(info['score'])} nodes {info['nodes']} "
+            f"nps {info['nps']} time {int(info['time'] * 1000)} pv {pv}"
+        )
+
+    def go(board, limits):
+        movetime = time_budget(
+            board,
+            limits.get("wtime"),
+            limits.get("btime"),
+            limits.get("winc", 0),
+            limits.get("binc", 0),
+            limits.get("movestogo"),
+            limits.get("movetime"),
+        )
+        search.reset_stats()
+        move, _ = search.search(board, limits.get("depth"), limits.get("nodes"), movetime, send_info)
+        send(f"bestmove {move.uci() if move else '0000'}")
+
+    def wait():
+        if searcher is not None:
+            searcher.join()
+
+    for line in input:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+
+        if command == "uci":
+            send(f"id name {name}")
+            send("uciok")
+        elif command == "isready":
+            send("readyok")
+        elif command == "ucinewgame":
+            wait()
+            search.clear()
+            board = chess.Board()
+        elif command == "position":
+            wait()
+            try:
+                board = board_from_uci_position(tokens[1:])
+            except ValueError as e:
+                send(f"info string invalid position: {e}")
+        elif command == "go":
+            wait()
+            limits = {}
+            for key, value in zip(tokens[1:], tokens[2:]):
+                if key in ("wtime", "btime", "winc", "binc", "movestogo", "movetime", "depth", "nodes"):
+                    limits[key] = int(value)
+            searcher = threading.Thread(target=go, args=(board, limits))
+            searcher.start()
+        elif command == "stop":
+            search.stop()
+            wait()
+        elif command == "quit":
+            search.stop()
+            wait()
+            break
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Alpha-beta chess engine evaluating positions with the extracted features, "
+        "speaking UCI on stdin/stdout"
+    )
+    parser.add_argument("--weights", type=str, help="JSON file of evaluation weights by feature column, in centipawns")
+    parser.add_argument("--hash", type=int, default=1 << 18, help="Transposition table entries (default 262144)")
+    parser.add_argument("--bench", action="store_true", help="Search the benchmark positions and report nodes per second")
+    parser.add_argument("--depth", type=int, help="Depth of each benchmark search (default 3 without --nodes)")
+    parser.add_argument("--nodes", type=int, help="Nodes of each benchmark search")
+    args = parser.parse_args()
+
+    try:
+        evaluator = Evaluator(load_weights(args.weights) if args.weights else EVAL_WEIGHTS)
+    except (OSError, ValueError) as e:
+        parser.error(f"cannot load weights {args.weights}: {e}")
+
+    if args.bench:
+        depth = args.depth if args.depth is not None or args.nodes is not None else 3
+        run_bench(evaluator, depth, args.nodes, args.hash)
+    else:
+        run_uci(Search(evaluator, args.hash), "Deezchess")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,208 @@ import chess
 #TODO: Add dynamic features function
 
 
+# Precomputed bitboard masks
+BB_CENTER = chess.BB_E4 | chess.BB_D4 | chess.BB_E5 | chess.BB_D5
+BB_OUTPOSTS = chess.BB_D3 | chess.BB_E3 | chess.BB_D6 | chess.BB_E6
+BB_INNER_RANKS = chess.BB_ALL & ~chess.BB_RANK_1 & ~chess.BB_RANK_8
+BB_KINGSIDE_FILES = chess.BB_FILE_E | chess.BB_FILE_F | chess.BB_FILE_G | chess.BB_FILE_H
+BB_QUEENSIDE_FILES = chess.BB_FILE_A | chess.BB_FILE_B | chess.BB_FILE_C
+
+# Same and adjacent files of every file
+BB_NEIGHBOUR_FILES = [
+    chess.BB_FILES[file]
+    | (chess.BB_FILES[file - 1] if file > 0 else 0)
+    | (chess.BB_FILES[file + 1] if file < 7 else 0)
+    for file in range(8)
+]
+
+
+def _forward_ranks(rank, color):
+    ranks = range(rank + 1, 8) if color == chess.WHITE else range(0, rank)
+    mask = 0
+    for r in ranks:
+        mask |= chess.BB_RANKS[r]
+    return mask
+
+
+# Squares on the same and adjacent files ahead of a pawn, indexed [color][square]
+BB_FORWARD_SPANS = [
+    [
+        BB_NEIGHBOUR_FILES[chess.square_file(square)]
+        & _forward_ranks(chess.square_rank(square), color)
+        for square in chess.SQUARES
+    ]
+    for color in [chess.BLACK, chess.WHITE]
+]
+
+
+# Attack sets and legal moves of a position, computed once and shared by
+# every feature that needs to know which squares are attacked or which
+# moves a piece has
+class AttackMap:
+    def __init__(self, board, legal_moves=None):
+        if legal_moves is None:
+            legal_moves = list(board.legal_moves)
+
+        # Attacked squares of every piece, by color and square, and the
+        # union per color
+        self.piece_attacks = [{}, {}]
+        self.attacks = [0, 0]
+        for color in [chess.WHITE, chess.BLACK]:
+            color_piece_attacks = self.piece_attacks[color]
+            color_attacks = 0
+            for square in chess.scan_forward(board.occupied_co[color]):
+                mask = board.attacks_mask(square)
+                color_piece_attacks[square] = mask
+                color_attacks |= mask
+            self.attacks[color] = color_attacks
+
+        # Legal moves grouped by the square they start from, with the
+        # target squares of each group as a bitboard
+        self.legal_moves = legal_moves
+        self.moves_from = {}
+        self.targets_from = {}
+        for move in legal_moves:
+            from_square = move.from_square
+            if from_square in self.moves_from:
+                self.moves_from[from_square].append(move)
+                self.targets_from[from_square] |= chess.BB_SQUARES[move.to_square]
+            else:
+                self.moves_from[from_square] = [move]
+                self.targets_from[from_square] = chess.BB_SQUARES[move.to_square]
+        self.move_counts = {square: len(moves) for square, moves in self.moves_from.items()}
+
+    # Attack map of the position after a move, derived from this map of the
+    # position before it. board is the position after the move and changed
+    # the squares whose piece changed (moved, captured, promoted, castling
+    # rook). Only the attack sets of the pieces on changed squares and of
+    # the sliders whose attacks reach one of them are recomputed. The legal
+    # moves of the side to move are derived from the attack sets and pins,
+    # for the pieces other than pawns only: targets_from and move_counts
+    # are filled in for those, legal_moves and moves_from are None. When
+    # the side to move is in check, and in Chess960, a full AttackMap of
+    # board is built instead.
+    def after_move(self, board, changed):
+        us = board.turn
+        them = not us
+        king = board.king(us)
+        if king is None or board.chess960:
+            return AttackMap(board)
+
+        BB_SQUARES = chess.BB_SQUARES
+        occupied = board.occupied
+        white = board.occupied_co[chess.WHITE]
+        piece_attacks = [
+            self.piece_attacks[chess.BLACK].copy(),
+            self.piece_attacks[chess.WHITE].copy(),
+        ]
+        changed_colors = [False, False]
+        for square in chess.scan_forward(changed):
+            for color in [chess.WHITE, chess.BLACK]:
+                if piece_attacks[color].pop(square, None) is not None:
+                    changed_colors[color] = True
+            if occupied & BB_SQUARES[square]:
+                color = bool(white & BB_SQUARES[square])
+                piece_attacks[color][square] = board.attacks_mask(square)
+                changed_colors[color] = True
+        for square in chess.scan_forward((board.bishops | board.rooks | board.queens) & ~changed):
+            color = bool(white & BB_SQUARES[square])
+            if piece_attacks[color][square] & changed:
+                piece_attacks[color][square] = board.attacks_mask(square)
+                changed_colors[color] = True
+
+        attacks = list(self.attacks)
+        for color in [chess.WHITE, chess.BLACK]:
+            if changed_colors[color]:
+                color_attacks = 0
+                for mask in piece_attacks[color].values():
+                    color_attacks |= mask
+                attacks[color] = color_attacks
+
+        if attacks[them] & BB_SQUARES[king]:
+            return AttackMap(board)
+
+        # Pieces pinned to the king: the only piece between it and an
+        # opposing slider on the same line
+        snipers = board.occupied_co[them] & (
+            (chess.BB_RANK_ATTACKS[king][0] | chess.BB_FILE_ATTACKS[king][0])
+            & (board.rooks | board.queens)
+            | chess.BB_DIAG_ATTACKS[king][0] & (board.bishops | board.queens)
+        )
+        pinned = 0
+        for sniper in chess.scan_forward(snipers):
+            blockers = chess.between(king, sniper) & occupied
+            if blockers and not blockers & (blockers - 1):
+                pinned |= blockers
+
+        # Not in check, a piece can move to every square it attacks that
+        # holds no piece of its own, along the pin line when pinned
+        own = board.occupied_co[us]
+        movable = own & ~board.pawns & ~board.kings
+        targets_from = {}
+        move_counts = {}
+        for square, mask in piece_attacks[us].items():
+            if movable & BB_SQUARES[square]:
+                targets = mask & ~own
+                if pinned & BB_SQUARES[square]:
+                    targets &= chess.BB_RAYS[king][square]
+                if targets:
+                    targets_from[square] = targets
+                    move_counts[square] = chess.popcount(targets)
+
+        # The king moves to unattacked squares, and castles when the squares
+        # between king and rook are empty and the king does not pass or land
+        # on an attacked square
+        king_targets = piece_attacks[us][king] & ~own & ~attacks[them]
+        backrank = chess.BB_RANK_1 if us == chess.WHITE else chess.BB_RANK_8
+        if board.castling_rights & backrank:
+            king_mask = BB_SQUARES[king]
+            for rook in chess.scan_forward(board.clean_castling_rights() & backrank):
+                a_side = rook < king
+                king_to = (chess.BB_FILE_C if a_side else chess.BB_FILE_G) & backrank
+                rook_to = (chess.BB_FILE_D if a_side else chess.BB_FILE_F) & backrank
+                king_path = chess.between(king, chess.msb(king_to))
+                rook_path = chess.between(rook, chess.msb(rook_to))
+                if not (
+                    (occupied ^ king_mask ^ BB_SQUARES[rook])
+                    & (king_path | rook_path | king_to | rook_to)
+                    or attacks[them] & (king_path | king_to)
+                ):
+                    king_targets |= king_to
+        if king_targets:
+            targets_from[king] = king_targets
+            move_counts[king] = chess.popcount(king_targets)
+
+        derived = object.__new__(AttackMap)
+        derived.piece_attacks = piece_attacks
+        derived.attacks = attacks
+        derived.legal_moves = None
+        derived.moves_from = None
+        derived.targets_from = targets_from
+        derived.move_counts = move_counts
+        return derived
+
+    def is_attacked_by(self, color, square):
+        return bool(self.attacks[color] & chess.BB_SQUARES[square])
+
+    # Pieces of the given color attacking the square
+    def attackers_mask(self, color, square):
+        attackers = 0
+        square_mask = chess.BB_SQUARES[square]
+        for attacker, mask in self.piece_attacks[color].items():
+            if mask & square_mask:
+                attackers |= chess.BB_SQUARES[attacker]
+        return attackers
+
+    # Number of legal moves of the pieces on the given squares
+    def count_moves_from(self, squares_mask):
+        return sum(
+            count
+            for square, count in self.move_counts.items()
+            if squares_mask & chess.BB_SQUARES[square]
+        )
+
+
 def material_balance(board):
     piece_values = {
         chess.PAWN: 1,
@@ -161,21 +363,13 @@ def pawn_structure(board):
 
 
 # Function to calculate control over central squares
-def center_control(board, is_white_player):
-    central_squares = [chess.E4, chess.D4, chess.E5, chess.D5]
-    player_control = 0
-
-    for square in central_squares:
-        if is_white_player:
-            # Add 1 for each square attacked by white
-            if board.is_attacked_by(chess.WHITE, square):
-                player_control += 1
-        else:
-            # Add 1 for each square attacked by black
-            if board.is_attacked_by(chess.BLACK, square):
-                player_control += 1
+def center_control(board, is_white_player, attack_map=None):
+    if attack_map is None:
+        attack_map = AttackMap(board)
 
-    return player_control
+    # Add 1 for each central square (e4, d4, e5, d5) attacked by the player
+    color = chess.WHITE if is_white_player else chess.BLACK
+    return chess.popcount(attack_map.attacks[color] & BB_CENTER)
 
 
 # Function to calculate the number of open files for rooks
@@ -221,17 +415,13 @@ def semi_open_files(board):
 
 
 # Function to calculate the total number of legal moves for all pieces
-def piece_mobility(board):
-    white_mobility = 0
-    black_mobility = 0
-
-    for move in board.legal_moves:
-        piece = board.piece_at(move.from_square)
-        if piece and piece.piece_type != chess.PAWN:
-            if piece.color == chess.WHITE:
-                white_mobility += 1
-            else:
-                black_mobility += 1
+def piece_mobility(board, attack_map=None):
+    if attack_map is None:
+        attack_map = AttackMap(board)
+
+    pieces = board.occupied & ~board.pawns
+    white_mobility = attack_map.count_moves_from(pieces & board.occupied_co[chess.WHITE])
+    black_mobility = attack_map.count_moves_from(pieces & board.occupied_co[chess.BLACK])
 
     return {
         "white_piece_mobility": white_mobility,
@@ -240,35 +430,23 @@ def piece_mobility(board):
 
 
 # Function to calculate the number of pieces actively attacking opponent squares
-def piece_activity(board):
-    white_activity = 0
-    black_activity = 0
-
-    # Iterate through pieces on the board
-    for square, piece in board.piece_map().items():
-        if piece.piece_type == chess.PAWN:  # Exclude pawns
-            continue
-
-        if piece.color == chess.WHITE:
-            # Check if the piece is attacking any black pieces
-            if any(
-                board.is_attacked_by(chess.BLACK, move.to_square)
-                for move in board.legal_moves
-                if move.from_square == square
-            ):
-                white_activity += 1
-        else:
-            # Check if the piece is attacking any white pieces
-            if any(
-                board.is_attacked_by(chess.WHITE, move.to_square)
-                for move in board.legal_moves
-                if move.from_square == square
-            ):
-                black_activity += 1
+def piece_activity(board, attack_map=None):
+    if attack_map is None:
+        attack_map = AttackMap(board)
+
+    def count_active(color):
+        # Pieces (excluding pawns) with a legal move to a square the opponent attacks
+        opponent_attacks = attack_map.attacks[not color]
+        pieces = board.occupied_co[color] & ~board.pawns
+        active = 0
+        for square, targets in attack_map.targets_from.items():
+            if pieces & chess.BB_SQUARES[square] and targets & opponent_attacks:
+                active += 1
+        return active
 
     return {
-        "white_piece_activity": white_activity,
-        "black_piece_activity": black_activity,
+        "white_piece_activity": count_active(chess.WHITE),
+        "black_piece_activity": count_active(chess.BLACK),
     }
 
 
@@ -290,63 +468,38 @@ def king_activity_endgame(board):
     }
 
 # Function to calculate the number of pieces attacking opponent pieces
-def threats(board):
-    white_attacking = 0
-    black_attacking = 0
-    white_hanging = 0
-    black_hanging = 0
-
-    # Iterate over pieces on the board
-    for square, piece in board.piece_map().items():
-        if piece.piece_type == chess.PAWN:  # Exclude pawns
-            continue
-
-        if piece.color == chess.WHITE:
-            # Count attacking pieces
-            if board.is_attacked_by(chess.BLACK, square):
-                white_attacking += 1
-            # Count hanging pieces
-            if not board.is_attacked_by(chess.WHITE, square):
-                white_hanging += 1
-
-        elif piece.color == chess.BLACK:
-            # Count attacking pieces
-            if board.is_attacked_by(chess.WHITE, square):
-                black_attacking += 1
-            # Count hanging pieces
-            if not board.is_attacked_by(chess.BLACK, square):
-                black_hanging += 1
+def threats(board, attack_map=None):
+    if attack_map is None:
+        attack_map = AttackMap(board)
+
+    # Pieces excluding pawns
+    white_pieces = board.occupied_co[chess.WHITE] & ~board.pawns
+    black_pieces = board.occupied_co[chess.BLACK] & ~board.pawns
+    white_attacks = attack_map.attacks[chess.WHITE]
+    black_attacks = attack_map.attacks[chess.BLACK]
 
     return {
-        "white_attacking_pieces": white_attacking,
-        "black_attacking_pieces": black_attacking,
-        "white_hanging_pieces": white_hanging,
-        "black_hanging_pieces": black_hanging,
+        "white_attacking_pieces": chess.popcount(white_pieces & black_attacks),
+        "black_attacking_pieces": chess.popcount(black_pieces & white_attacks),
+        "white_hanging_pieces": chess.popcount(white_pieces & ~white_attacks),
+        "black_hanging_pieces": chess.popcount(black_pieces & ~black_attacks),
     }
 
 
 # Function to calculate space advantage (total squares controlled in opponent's territory)
-def space_advantage(board, is_white):
-    controlled_squares = 0
-
-    # Define the range of squares that represent the opponent's territory
-    opponent_territory_start = 32  # For black: 32 to 63; for white: 0 to 31
-    opponent_territory_end = 64 if is_white else 32
-
-    # Iterate over the squares in the opponent's territory
-    for square in range(opponent_territory_start, opponent_territory_end):
-        if is_white:  # Calculate for white's advantage
-            if board.is_attacked_by(chess.WHITE, square):
-                controlled_squares += 1
-            if board.is_attacked_by(chess.BLACK, square):
-                controlled_squares -= 1
-        else:  # Calculate for black's advantage
-            if board.is_attacked_by(chess.BLACK, square):
-                controlled_squares += 1
-            if board.is_attacked_by(chess.WHITE, square):
-                controlled_squares -= 1
-
-    return controlled_squares
+def space_advantage(board, is_white, attack_map=None):
+    if attack_map is None:
+        attack_map = AttackMap(board)
+
+    # The opponent's territory spans squares 32 to 63 for white and the empty
+    # range 32 to 31 for black, so black never gains space
+    if not is_white:
+        return 0
+
+    territory = chess.BB_RANK_5 | chess.BB_RANK_6 | chess.BB_RANK_7 | chess.BB_RANK_8
+    return chess.popcount(attack_map.attacks[chess.WHITE] & territory) - chess.popcount(
+        attack_map.attacks[chess.BLACK] & territory
+    )
 
 
 # Function to check if one side has a bishop pair
@@ -458,6 +611,509 @@ def passed_pawn_advancement(board, is_white_player):
 
     return advancement
 
+# Column names of the handcrafted features, in the order they are written out
+FEATURE_NAMES = [
+    "white_material_balance",
+    "black_material_balance",
+    "material_imbalance",
+    "minor_piece_imbalance",
+    "white_king_castled",
+    "black_king_castled",
+    "white_isolated_pawns",
+    "white_backward_pawns",
+    "white_passed_pawns",
+    "black_isolated_pawns",
+    "black_backward_pawns",
+    "black_passed_pawns",
+    "center_control",
+    "open_files",
+    "white_semi_open_files",
+    "black_semi_open_files",
+    "white_piece_mobility",
+    "black_piece_mobility",
+    "white_piece_activity",
+    "black_piece_activity",
+    "white_king_dist_to_center",
+    "black_king_dist_to_center",
+    "white_attacking_pieces",
+    "white_hanging_pieces",
+    "black_attacking_pieces",
+    "black_hanging_pieces",
+    "player_space_advantage",
+    "white_bishop_pair",
+    "black_bishop_pair",
+    "player_knight_outposts",
+    "rook_on_seventh_rank",
+    "white_pawn_majority",
+    "black_pawn_majority",
+    "player_passed_pawn_advancement",
+]
+
+
+# Intermediate results shared by several features. Each is computed at
+# most once per position, and only when a selected feature requires it.
+def _minor_piece_counts(board):
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+    popcount = chess.popcount
+    return (
+        popcount(board.bishops & white),
+        popcount(board.bishops & black),
+        popcount(board.knights & white),
+        popcount(board.knights & black),
+    )
+
+
+# Columns of the features that only depend on pawn placement, for both
+# players, keyed by feature name
+def _pawn_values(white_pawns, black_pawns):
+    popcount = chess.popcount
+
+    # pawn_structure compares board.piece_at() against a bare piece type,
+    # which never matches, so every pawn counts as isolated, backward and passed
+    white_pawn_count = popcount(white_pawns)
+    black_pawn_count = popcount(black_pawns)
+
+    white_semi_open = 0
+    black_semi_open = 0
+    for file_mask in chess.BB_FILES:
+        has_white_pawn = white_pawns & file_mask
+        has_black_pawn = black_pawns & file_mask
+        if has_white_pawn and not has_black_pawn:
+            white_semi_open += 1
+        elif has_black_pawn and not has_white_pawn:
+            black_semi_open += 1
+
+    # Passed pawn advancement of each side's pawns, indexed by color
+    white_advancement = 0
+    spans = BB_FORWARD_SPANS[chess.WHITE]
+    for square in chess.scan_forward(white_pawns):
+        if not spans[square] & black_pawns:
+            white_advancement += square >> 3
+    black_advancement = 0
+    spans = BB_FORWARD_SPANS[chess.BLACK]
+    for square in chess.scan_forward(black_pawns):
+        if not spans[square] & white_pawns:
+            black_advancement += 7 - (square >> 3)
+
+    return {
+        "pawn_structure": {
+            "white_isolated_pawns": white_pawn_count,
+            "white_backward_pawns": white_pawn_count,
+            "white_passed_pawns": white_pawn_count,
+            "black_isolated_pawns": black_pawn_count,
+            "black_backward_pawns": black_pawn_count,
+            "black_passed_pawns": black_pawn_count,
+        },
+        "semi_open_files": {
+            "white_semi_open_files": white_semi_open,
+            "black_semi_open_files": black_semi_open,
+        },
+        "pawn_majority": {
+            "white_pawn_majority": popcount(white_pawns & BB_KINGSIDE_FILES),
+            "black_pawn_majority": popcount(black_pawns & BB_QUEENSIDE_FILES),
+        },
+        "passed_pawn_advancement": (
+            {"player_passed_pawn_advancement": black_advancement},
+            {"player_passed_pawn_advancement": white_advancement},
+        ),
+    }
+
+
+# Pawn hash table, as in engines: the pawn-only columns of recently seen
+# pawn structures in a fixed number of slots. The pair of pawn bitboards is
+# the key; its hash picks the slot, and a new structure replaces whatever
+# was in its slot. Pawns move on a minority of moves, so most positions of
+# a game, and structures repeated across games, are found in the table.
+PAWN_TABLE_SIZE = 1 << 14
+_pawn_table = [None] * PAWN_TABLE_SIZE
+
+
+def _pawn_entry(board):
+    key = (board.pawns & board.occupied_co[chess.WHITE], board.pawns & board.occupied_co[chess.BLACK])
+    slot = hash(key) & (PAWN_TABLE_SIZE - 1)
+    entry = _pawn_table[slot]
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    values = _pawn_values(*key)
+    _pawn_table[slot] = (key, values)
+    return values
+
+
+INTERMEDIATES = {
+    "attack_map": AttackMap,
+    "minor_pieces": _minor_piece_counts,
+    "pawn_entry": _pawn_entry,
+}
+
+# Kinds of moves that can change a feature's value, used to reuse the
+# parent position's values in extract_after_move. Moving, capturing or
+# promoting to a piece all count as touching it.
+ANY_MOVE = "any"
+MATERIAL_MOVES = "captures and pawn moves"
+PAWN_MOVES = "moves touching pawns"
+KING_MOVES = "king moves"
+KNIGHT_MOVES = "moves touching knights"
+ROOK_MOVES = "moves touching rooks"
+CASTLING_MOVES = "moves touching the king and rook starting squares"
+
+BB_CASTLING_SQUARES = (
+    chess.BB_A1 | chess.BB_E1 | chess.BB_H1 | chess.BB_A8 | chess.BB_E8 | chess.BB_H8
+)
+
+
+# A feature of the registry: the columns it fills in, the intermediates its
+# compute function takes after (board, is_white_player), and the kind of
+# moves that can change its value
+class Feature:
+    def __init__(self, name, columns, compute, requires=(), changes_with=ANY_MOVE):
+        self.name = name
+        self.columns = columns
+        self.compute = compute
+        self.requires = requires
+        self.changes_with = changes_with
+
+
+# Registered features by name, in the order they are computed
+FEATURES = {}
+
+
+def feature(name, columns, requires=(), changes_with=ANY_MOVE):
+    def register(compute):
+        FEATURES[name] = Feature(name, columns, compute, requires, changes_with)
+        return compute
+
+    return register
+
+
+# Material balance, with the bishop pair bonus when no pawn is in the center
+@feature(
+    "material_balance",
+    ["white_material_balance", "black_material_balance", "material_imbalance"],
+    requires=("minor_pieces",),
+    changes_with=MATERIAL_MOVES,
+)
+def _material_balance_feature(board, is_white_player, minor_pieces):
+    white_bishops, black_bishops, white_knights, black_knights = minor_pieces
+    pawns = board.pawns
+    popcount = chess.popcount
+    center_open = not pawns & BB_CENTER
+
+    def calculate_material(color_mask, bishop_count, knight_count):
+        material = (
+            popcount(pawns & color_mask)
+            + 3 * knight_count
+            + 3 * bishop_count
+            + 5 * popcount(board.rooks & color_mask)
+            + 9 * popcount(board.queens & color_mask)
+        )
+        if center_open and bishop_count == 2:
+            material += 0.5 * bishop_count
+        return material
+
+    white_material = calculate_material(
+        board.occupied_co[chess.WHITE], white_bishops, white_knights
+    )
+    black_material = calculate_material(
+        board.occupied_co[chess.BLACK], black_bishops, black_knights
+    )
+    return {
+        "white_material_balance": white_material,
+        "black_material_balance": black_material,
+        "material_imbalance": white_material - black_material,
+    }
+
+
+@feature(
+    "minor_piece_imbalance",
+    ["minor_piece_imbalance"],
+    requires=("minor_pieces",),
+    changes_with=MATERIAL_MOVES,
+)
+def _minor_piece_imbalance_feature(board, is_white_player, minor_pieces):
+    white_bishops, black_bishops, white_knights, black_knights = minor_pieces
+    imbalance = white_knights != black_knights or white_bishops != black_bishops
+    return {"minor_piece_imbalance": 1 if imbalance else 0}
+
+
+@feature(
+    "bishop_pair",
+    ["white_bishop_pair", "black_bishop_pair"],
+    requires=("minor_pieces",),
+    changes_with=MATERIAL_MOVES,
+)
+def _bishop_pair_feature(board, is_white_player, minor_pieces):
+    white_bishops, black_bishops, _, _ = minor_pieces
+    return {
+        "white_bishop_pair": 1 if white_bishops == 2 else 0,
+        "black_bishop_pair": 1 if black_bishops == 2 else 0,
+    }
+
+
+@feature("king_safety", ["white_king_castled", "black_king_castled"], changes_with=CASTLING_MOVES)
+def _king_safety_feature(board, is_white_player):
+    return king_safety(board)
+
+
+@feature(
+    "pawn_structure",
+    [
+        "white_isolated_pawns",
+        "white_backward_pawns",
+        "white_passed_pawns",
+        "black_isolated_pawns",
+        "black_backward_pawns",
+        "black_passed_pawns",
+    ],
+    requires=("pawn_entry",),
+    changes_with=PAWN_MOVES,
+)
+def _pawn_structure_feature(board, is_white_player, pawn_entry):
+    return pawn_entry["pawn_structure"]
+
+
+@feature("center_control", ["center_control"], requires=("attack_map",))
+def _center_control_feature(board, is_white_player, attack_map):
+    return {"center_control": center_control(board, is_white_player, attack_map)}
+
+
+@feature("open_files", ["open_files"])
+def _open_files_feature(board, is_white_player):
+    open_file_count = 0
+    for file_mask in chess.BB_FILES:
+        if not board.occupied & file_mask & BB_INNER_RANKS:
+            open_file_count += 1
+    return {"open_files": open_file_count}
+
+
+@feature(
+    "semi_open_files",
+    ["white_semi_open_files", "black_semi_open_files"],
+    requires=("pawn_entry",),
+    changes_with=PAWN_MOVES,
+)
+def _semi_open_files_feature(board, is_white_player, pawn_entry):
+    return pawn_entry["semi_open_files"]
+
+
+@feature(
+    "piece_mobility",
+    ["white_piece_mobility", "black_piece_mobility"],
+    requires=("attack_map",),
+)
+def _piece_mobility_feature(board, is_white_player, attack_map):
+    return piece_mobility(board, attack_map)
+
+
+@feature(
+    "piece_activity",
+    ["white_piece_activity", "black_piece_activity"],
+    requires=("attack_map",),
+)
+def _piece_activity_feature(board, is_white_player, attack_map):
+    return piece_activity(board, attack_map)
+
+
+@feature(
+    "king_activity_endgame",
+    ["white_king_dist_to_center", "black_king_dist_to_center"],
+    changes_with=KING_MOVES,
+)
+def _king_activity_endgame_feature(board, is_white_player):
+    return king_activity_endgame(board)
+
+
+@feature(
+    "threats",
+    [
+        "white_attacking_pieces",
+        "white_hanging_pieces",
+        "black_attacking_pieces",
+        "black_hanging_pieces",
+    ],
+    requires=("attack_map",),
+)
+def _threats_feature(board, is_white_player, attack_map):
+    return threats(board, attack_map)
+
+
+@feature("space_advantage", ["player_space_advantage"], requires=("attack_map",))
+def _space_advantage_feature(board, is_white_player, attack_map):
+    return {"player_space_advantage": space_advantage(board, is_white_player, attack_map)}
+
+
+@feature("knight_outposts", ["player_knight_outposts"], changes_with=KNIGHT_MOVES)
+def _knight_outposts_feature(board, is_white_player):
+    player = board.occupied_co[chess.WHITE if is_white_player else chess.BLACK]
+    return {"player_knight_outposts": chess.popcount(board.knights & player & BB_OUTPOSTS)}
+
+
+@feature("rook_on_seventh_rank", ["rook_on_seventh_rank"], changes_with=ROOK_MOVES)
+def _rook_on_seventh_rank_feature(board, is_white_player):
+    white_rooks = board.rooks & board.occupied_co[chess.WHITE]
+    return {"rook_on_seventh_rank": chess.popcount(white_rooks & chess.BB_RANK_8)}
+
+
+@feature(
+    "pawn_majority",
+    ["white_pawn_majority", "black_pawn_majority"],
+    requires=("pawn_entry",),
+    changes_with=PAWN_MOVES,
+)
+def _pawn_majority_feature(board, is_white_player, pawn_entry):
+    return pawn_entry["pawn_majority"]
+
+
+@feature(
+    "passed_pawn_advancement",
+    ["player_passed_pawn_advancement"],
+    requires=("pawn_entry",),
+    changes_with=PAWN_MOVES,
+)
+def _passed_pawn_advancement_feature(board, is_white_player, pawn_entry):
+    return pawn_entry["passed_pawn_advancement"][1 if is_white_player else 0]
+
+
+# Names of the features to compute: the given ones (every registered
+# feature when include is None) without the excluded ones, in registry order
+def select_features(include=None, exclude=()):
+    unknown = [name for name in list(include or ()) + list(exclude) if name not in FEATURES]
+    if unknown:
+        raise ValueError(
+            f"Unknown features: {', '.join(unknown)} (known: {', '.join(FEATURES)})"
+        )
+    return [
+        name
+        for name in FEATURES
+        if (include is None or name in include) and name not in exclude
+    ]
+
+
+# Columns filled in by the given features, in FEATURE_NAMES order
+def feature_columns(features):
+    columns = {column for name in features for column in FEATURES[name].columns}
+    return [name for name in FEATURE_NAMES if name in columns]
+
+
+def required_intermediates(features):
+    return {requirement for name in features for requirement in FEATURES[name].requires}
+
+
+# Compute the columns of the given features (every registered feature by
+# default) from the board's bitboards. Returns a dict keyed by column name
+# with the same values as the square-by-square functions above. An
+# attack_map built by the caller is used instead of building one.
+def extract_all(board, is_white_player, attack_map=None, features=None):
+    if features is None:
+        features = FEATURES
+
+    shared = {} if attack_map is None else {"attack_map": attack_map}
+    values = {}
+    for name in features:
+        feature = FEATURES[name]
+        if feature.requires:
+            args = []
+            for requirement in feature.requires:
+                if requirement not in shared:
+                    shared[requirement] = INTERMEDIATES[requirement](board)
+                args.append(shared[requirement])
+            values.update(feature.compute(board, is_white_player, *args))
+        else:
+            values.update(feature.compute(board, is_white_player))
+    return values
+
+
+def _piece_bitboards(board):
+    return (
+        board.pawns,
+        board.knights,
+        board.bishops,
+        board.rooks,
+        board.queens,
+        board.kings,
+        board.occupied_co[chess.WHITE],
+        board.occupied_co[chess.BLACK],
+    )
+
+
+# Kinds of moves (see Feature.changes_with) a move between the positions
+# with the given piece bitboards belongs to, and the squares whose piece
+# changed
+def _move_kinds(before, after):
+    changed = 0
+    for before_mask, after_mask in zip(before, after):
+        changed |= before_mask ^ after_mask
+
+    kinds = {ANY_MOVE}
+    pawns = before[0] | after[0]
+    if changed & pawns:
+        kinds.update((PAWN_MOVES, MATERIAL_MOVES))
+    elif chess.popcount(before[6] | before[7]) != chess.popcount(after[6] | after[7]):
+        kinds.add(MATERIAL_MOVES)
+    if changed & (before[1] | after[1]):
+        kinds.add(KNIGHT_MOVES)
+    if changed & (before[3] | after[3]):
+        kinds.add(ROOK_MOVES)
+    if changed & (before[5] | after[5]):
+        kinds.add(KING_MOVES)
+    if changed & BB_CASTLING_SQUARES:
+        kinds.add(CASTLING_MOVES)
+    return frozenset(kinds), changed
+
+
+# Compute the columns of the position after a candidate move from the
+# columns of the position before it (as returned by extract_all). The move
+# is pushed on the board and popped again, so no copy is made. Features
+# that the move cannot change (see Feature.changes_with) are reused; the
+# remaining ones are recomputed for the new position. Given the attack_map
+# of the position before the move, the new position's attack map is
+# derived from it (see AttackMap.after_move) instead of built from scratch.
+def extract_after_move(
+    board, move, is_white_player, parent_features, features=None, attack_map=None
+):
+    if features is None:
+        features = FEATURES
+
+    before = _piece_bitboards(board)
+    board.push(move)
+    try:
+        kinds, changed = _move_kinds(before, _piece_bitboards(board))
+        recomputed, reused_columns, uses_attack_map = _after_move_plan(features, kinds)
+        child_attack_map = None
+        if attack_map is not None and uses_attack_map:
+            child_attack_map = attack_map.after_move(board, changed)
+        values = extract_all(board, is_white_player, child_attack_map, recomputed)
+    finally:
+        board.pop()
+
+    for column in reused_columns:
+        values[column] = parent_features[column]
+    return values
+
+
+# Features to recompute after a move of the given kinds, the columns to
+# reuse from the parent position and whether an attack map is needed, by
+# features and kinds
+_after_move_plans = {}
+
+
+def _after_move_plan(features, kinds):
+    key = (tuple(features), kinds)
+    plan = _after_move_plans.get(key)
+    if plan is None:
+        recomputed = [name for name in features if FEATURES[name].changes_with in kinds]
+        reused_columns = [
+            column
+            for name in features
+            if name not in recomputed
+            for column in FEATURES[name].columns
+        ]
+        plan = (recomputed, reused_columns, "attack_map" in required_intermediates(recomputed))
+        _after_move_plans[key] = plan
+    return plan
+
+
 def calculate_total_squares_king_can_safely_move_to(board, is_white_player):
 
     if is_white_player:
@@ -0,0 +1,162 @@
+import hashlib
+import inspect
+import json
+import marshal
+import sqlite3
+import types
+
+import chess
+
+import extract_features
+from extract_features import FEATURES, INTERMEDIATES, feature_columns
+
+
+# Hash of the source of obj and of every function, class and constant of
+# extract_features it refers to, followed recursively. Only upper-case
+# names count as constants, so module state such as the pawn hash table
+# is left out.
+def _add_source(digest, obj, seen):
+    obj = inspect.unwrap(obj)
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    digest.update(inspect.getsource(obj).encode())
+
+    if isinstance(obj, type):
+        codes = [
+            member.__code__ for member in vars(obj).values() if isinstance(member, types.FunctionType)
+        ]
+    else:
+        codes = [obj.__code__]
+
+    names = set()
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+
+    for name in sorted(names):
+        value = vars(extract_features).get(name)
+        if isinstance(value, (types.FunctionType, type)):
+            if value.__module__ == extract_features.__name__:
+                _add_source(digest, value, seen)
+        elif name.isupper() and isinstance(value, (int, float, str, list, tuple)):
+            digest.update(f"{name}={value!r}".encode())
+
+
+# Fingerprint of one feature's code: its compute function, the
+# intermediates it requires and everything they use in extract_features
+def feature_fingerprint(name):
+    feature = FEATURES[name]
+    digest = hashlib.sha256()
+    seen = set()
+    _add_source(digest, feature.compute, seen)
+    for requirement in feature.requires:
+        _add_source(digest, INTERMEDIATES[requirement], seen)
+    return digest.hexdigest()
+
+
+# Identifier of the cache entries of a feature selection: changes with the
+# code of any selected feature, the columns and the python-chess version
+def selection_version(fingerprints, columns):
+    digest = hashlib.sha256(json.dumps([fingerprints, columns, chess.__version__]).encode())
+    return int.from_bytes(digest.digest()[:8], "big", signed=True)
+
+
+# SQLite stores signed 64-bit integers
+def _signed(key):
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+# Persistent cache of the feature columns of positions, keyed by Zobrist
+# hash and the player's color, for the given feature selection. Entries
+# are stored under a version derived from the code of the selected
+# features; on open, entries of versions whose features have changed since
+# are deleted. New entries are written in transactions of commit_every
+# positions, so that workers sharing the file rarely wait on each other.
+class FeatureCache:
+    def __init__(self, path, features, commit_every=10000):
+        self.columns = feature_columns(features)
+        fingerprints = {name: feature_fingerprint(name) for name in features}
+        self.version = selection_version(fingerprints, self.columns)
+        self.commit_every = commit_every
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS versions "
+                "(version INTEGER PRIMARY KEY, fingerprints TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS features "
+                "(version INTEGER, hash INTEGER, is_white INTEGER, vals BLOB NOT NULL, "
+                "PRIMARY KEY (version, hash, is_white)) WITHOUT ROWID"
+            )
+            self._drop_stale_versions()
+            self.connection.execute(
+                "INSERT OR IGNORE INTO versions VALUES (?, ?)",
+                (self.version, json.dumps(fingerprints, sort_keys=True)),
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Delete the entries of feature code that no longer exists
+    def _drop_stale_versions(self):
+        current = {}
+        for version, stored in self.connection.execute("SELECT version, fingerprints FROM versions").fetchall():
+            fingerprints = json.loads(stored)
+            for name, fingerprint in fingerprints.items():
+                if name not in FEATURES:
+                    break
+                if name not in current:
+                    current[name] = feature_fingerprint(name)
+                if current[name] != fingerprint:
+                    break
+            else:
+                continue
+            self.connection.execute("DELETE FROM features WHERE version = ?", (version,))
+            self.connection.execute("DELETE FROM versions WHERE version = ?", (version,))
+
+    # Feature values by column of a position, or None when not cached
+    def get(self, key, is_white):
+        entry = (_signed(key), 1 if is_white else 0)
+        vals = self.pending.get(entry)
+        if vals is None:
+            row = self.connection.execute(
+                "SELECT vals FROM features WHERE version = ? AND hash = ? AND is_white = ?",
+                (self.version,) + entry,
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            vals = row[0]
+        self.hits += 1
+        return dict(zip(self.columns, marshal.loads(vals)))
+
+    def put(self, key, is_white, features):
+        entry = (_signed(key), 1 if is_white else 0)
+        self.pending[entry] = marshal.dumps([features[name] for name in self.columns])
+        if len(self.pending) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?)",
+                [(self.version,) + entry + (vals,) for entry, vals in self.pending.items()],
+            )
+        self.pending = {}
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -1,36 +1,55 @@
 import chess
 import chess.pgn
 import chess.polyglot
+import contextlib
 import csv
+import io
 import os
+import queue
+import sys
+import threading
 import argparse
+from multiprocessing import Pool
 from tqdm import tqdm
 
 from extract_features import (
-    material_balance,
-    material_imbalance,
-    minor_piece_imbalance,
-    king_safety,
-    pawn_structure,
-    center_control,
-    open_files,
-    semi_open_files,
-    piece_mobility,
-    piece_activity,
-    king_activity_endgame,
-    threats,
-    space_advantage,
-    bishop_pair,
-    knight_outposts,
-    rook_on_seventh_rank,
-    pawn_majority,
-    passed_pawn_advancement,
+    FEATURES,
+    AttackMap,
+    extract_after_move,
+    extract_all,
+    feature_columns,
+    required_intermediates,
+    select_features,
 )
+from checkpoint import Checkpointer, load_checkpoint, load_processed_ids
+from columnar_output import ColumnarWriter
+from normalized_output import NormalizedWriter
+from opening_book import OpeningBookBuilder
+from pgn_index import filter_index, find_game, load_index, read_game_at, shard_entries
+from pgn_input import is_compressed, open_pgn, strip_compression_extension
+from feature_cache import FeatureCache
+from merge_shards import write_shard_info
+from negative_sampling import NegativeSampler
+from profiler import Profiler, TimedWriter
+import tensor_output
+from tensor_output import TensorWriter
+
+
+max_number_opening_moves = 10
+
+
+# Header row of a CSV output with the given feature columns, and the
+# sample_weight column of negative sampling
+def csv_header(columns, sample_weight=False):
+    header = ["is_white_player", "position_fen", "move"] + columns + ["label"]
+    if sample_weight:
+        header.append("sample_weight")
+    return header
 
 
 # Extract the player's name from the PGN file name
 def extract_player_name_from_filename(pgn_filename):
-    return os.path.splitext(os.path.basename(pgn_filename))[0]
+    return os.path.splitext(os.path.basename(strip_compression_extension(pgn_filename)))[0]
 
 
 # Function to identify if the current player is white
@@ -44,243 +63,1124 @@ def is_player_white(game, player_name):
 
     return white_player_name == player_name
 
-parser = argparse.ArgumentParser(description="Convert PGN file to csv file of features for each possible position of every game in the file")
-parser.add_argument("input_file", type=str, help="The path to the input PGN file")
-parser.add_argument("output_file", type=str, help="The path to the output csv file")
-args = parser.parse_args()
-max_number_opening_moves = 10
 
+# Legal moves of the position, in python-chess's generation order
+def generate_legal_moves(board):
+    return list(board.legal_moves)
 
-pgn_file = args.input_file
-output_file = args.output_file
-player_name = extract_player_name_from_filename(pgn_file)
 
-num_of_games = 0
+# Stages timed by --profile, as stage name: function name in this module
+PROFILED_STAGES = {
+    "movegen": "generate_legal_moves",
+    "attack_map": "AttackMap",
+    "features": "extract_all",
+    "features.after_move": "extract_after_move",
+}
 
 
+# Replace the functions of the extraction loop, and the compute function of
+# every registered feature, by timed wrappers
+def instrument_extraction(profiler):
+    profiler.instrument(chess.pgn, {"parse": "read_game"})
+    profiler.instrument(sys.modules[__name__], PROFILED_STAGES)
+    for name, feature in FEATURES.items():
+        profiler.instrument(feature, {f"feature.{name}": "compute"})
 
-data = []
-num_of_positions = 0
-print(f"Opening files...")
 
-#Create polyglot opening book
-def create_player_opening_book(pgn_file, output_book, max_moves=10):
-    player_name = os.path.splitext(os.path.basename(pgn_file))[0]
-    book_data = {}
-    entries = []  # List to hold all book entries
-    pbar = tqdm(desc="Creating opening book: ", unit="moves")
+# Writes one row per legal move of every position after the opening to a
+# csv.writer or any other object with a writerow method. Only the columns of
+# the given features (all by default) are computed and written. With a
+# NegativeSampler only the sampled moves are written, each row ending with
+# its sample weight. With a FeatureCache, features of positions it already
+# has are read from it instead of being computed.
+class FeatureRowWriter:
+    def __init__(
+        self, writer, player_name, after_move=False, features=None, sampler=None, cache=None
+    ):
+        self.writer = writer
+        self.player_name = player_name
+        self.after_move = after_move
+        self.sampler = sampler
+        self.cache = cache
+        self.features = select_features() if features is None else features
+        self.columns = feature_columns(self.features)
+        self.uses_attack_map = "attack_map" in required_intermediates(self.features)
+        self.num_of_rows = 0
 
-    # Parse PGN file
-    with open(pgn_file, 'r') as f:
-        while True:
-            game = chess.pgn.read_game(f)
-            if game is None:
-                break
-            
-            # Identify the target player (as White or Black)
-            is_white = game.headers.get("White") == player_name
-            is_black = game.headers.get("Black") == player_name
-            if not is_white and not is_black:
-                continue
-
-            board = game.board()
-            move_count = 0
-            
-            # Traverse the moves of the game
-            for move in game.mainline_moves():
-                move_count += 1
-                # Restrict to the first `max_moves` in the game
-                if move_count > max_moves:
-                    break
-                
-                # Add the move only if it's played by the target player
-                if (is_white and board.turn) or (is_black and not board.turn):
-                    fen = board.fen()
-                    
-                    # Track move frequencies for the opening book
-                    if fen not in book_data:
-                        book_data[fen] = {}
-                    
-                    uci_move = move.uci()
-                    if uci_move not in book_data[fen]:
-                        book_data[fen][uci_move] = 0
-                    book_data[fen][uci_move] += 1
-                
-                board.push(move)
-                pbar.update(1)
-
-    # Collect all entries from book_data into a list
-    for fen, moves in book_data.items():
-        for move, weight in moves.items():
-            entry = chess.polyglot.Entry(
-                key=chess.polyglot.zobrist_hash(chess.Board(fen)),
-                raw_move=0,  # You can modify this if needed
-                weight=weight,
-                learn=0,  # You can modify this if needed
-                move=chess.Move.from_uci(move)
+    def start_game(self, game):
+        self.is_white = is_player_white(game, self.player_name)
+        return True
+
+    def move(self, board, move, ply):
+        # Skip the first 10 moves (opening phase)
+        if ply <= max_number_opening_moves:
+            return
+
+        is_white = self.is_white
+        fen = board.fen()
+        legal_moves = generate_legal_moves(board)
+
+        # With --after-move the position's attack map is also needed to
+        # derive the attack maps of the positions after each move
+        attack_map = None
+        if self.after_move and self.uses_attack_map:
+            attack_map = AttackMap(board, legal_moves)
+        position_features = self.position_features(board, legal_moves, attack_map)
+        feature_values = [position_features[name] for name in self.columns]
+
+        if self.sampler is None:
+            candidates = [(legal_move, None) for legal_move in legal_moves]
+        else:
+            candidates = self.sampler.sample(fen, legal_moves, move)
+
+        for legal_move, sample_weight in candidates:
+            # Get feature values for the position after the candidate move
+            if self.after_move:
+                move_features = self.move_features(
+                    board, legal_move, position_features, attack_map
+                )
+                feature_values = [move_features[name] for name in self.columns]
+
+            features = (
+                [1 if is_white else 0, fen, legal_move.uci()]  # move in UCI notation
+                + feature_values
+                + [
+                    1 if legal_move == move else 0
+                ]  # label (1 if the move is actually made, 0 otherwise)
             )
-            entries.append(entry)
-
-    # Sort entries by Zobrist hash (key)
-    entries.sort(key=lambda entry: entry.key)
-
-    # Save the opening book in Polyglot format
-    with open(output_book, 'wb') as book:
-        for entry in entries:
-            book.write(entry.key.to_bytes(8, 'big'))  # Write the Zobrist hash (8 bytes)
-            book.write(entry.raw_move.to_bytes(2, 'big'))  # Write the raw move (2 bytes)
-            book.write(entry.weight.to_bytes(2, 'big'))  # Write the weight (2 bytes)
-            book.write(entry.learn.to_bytes(4, 'big'))  # Write the learn field (4 bytes)
-                
-    print(f"Polyglot book created: {output_book}")
-    pbar.close()
+            if sample_weight is not None:
+                features.append(sample_weight)
+
+            # Write the data to the CSV
+            self.writer.writerow(features)
+            self.num_of_rows += 1
+
+    def position_features(self, board, legal_moves, attack_map=None):
+        if self.cache is not None:
+            key = chess.polyglot.zobrist_hash(board)
+            features = self.cache.get(key, self.is_white)
+            if features is not None:
+                return features
+
+        if attack_map is None and self.uses_attack_map:
+            attack_map = AttackMap(board, legal_moves)
+        features = extract_all(board, self.is_white, attack_map, self.features)
+        if self.cache is not None:
+            self.cache.put(key, self.is_white, features)
+        return features
+
+    # Features of the position after a candidate move
+    def move_features(self, board, move, position_features, attack_map=None):
+        if self.cache is None:
+            return extract_after_move(
+                board, move, self.is_white, position_features, self.features, attack_map
+            )
+
+        board.push(move)
+        key = chess.polyglot.zobrist_hash(board)
+        board.pop()
+        features = self.cache.get(key, self.is_white)
+        if features is None:
+            features = extract_after_move(
+                board, move, self.is_white, position_features, self.features, attack_map
+            )
+            self.cache.put(key, self.is_white, features)
+        return features
+
+    def end_game(self):
+        pass
 
-create_player_opening_book(pgn_file, f"{player_name}.bin")
-
-# Store fen positions with features after opening
-with open(pgn_file) as pgn, open(output_file, "w", newline="") as csv_file:
-    csv_writer = csv.writer(csv_file)
-
-    csv_writer.writerow(
-        [
-            "is_white_player",
-            "position_fen",
-            "move",
-            "white_material_balance",
-            "black_material_balance",
-            "material_imbalance",
-            "minor_piece_imbalance",
-            "white_king_castled",
-            "black_king_castled",
-            "white_isolated_pawns",
-            "white_backward_pawns",
-            "white_passed_pawns",
-            "black_isolated_pawns",
-            "black_backward_pawns",
-            "black_passed_pawns",
-            "center_control",
-            "open_files",
-            "white_semi_open_files",
-            "black_semi_open_files",
-            "white_piece_mobility",
-            "black_piece_mobility",
-            "white_piece_activity",
-            "black_piece_activity",
-            "white_king_dist_to_center",
-            "black_king_dist_to_center",
-            "white_attacking_pieces",
-            "white_hanging_pieces",
-            "black_attacking_pieces",
-            "black_hanging_pieces",
-            "player_space_advantage",
-            "white_bishop_pair",
-            "black_bishop_pair",
-            "player_knight_outposts",
-            "rook_on_seventh_rank",
-            "white_pawn_majority",
-            "black_pawn_majority",
-            "player_passed_pawn_advancement",
-            "label",
+
+# Writes every position after the opening once to a NormalizedWriter, keyed
+# by Zobrist hash, and the candidate moves of each occurrence. Features are
+# only computed the first time a position is seen.
+class NormalizedRowWriter:
+    def __init__(self, writer, player_name, features=None, sampler=None, cache=None):
+        self.writer = writer
+        self.player_name = player_name
+        self.sampler = sampler
+        self.cache = cache
+        self.features = select_features() if features is None else features
+        self.columns = feature_columns(self.features)
+        self.uses_attack_map = "attack_map" in required_intermediates(self.features)
+
+    @property
+    def num_of_rows(self):
+        return self.writer.num_of_rows
+
+    def start_game(self, game):
+        self.is_white = is_player_white(game, self.player_name)
+        return True
+
+    def move(self, board, move, ply):
+        # Skip the first 10 moves (opening phase)
+        if ply <= max_number_opening_moves:
+            return
+
+        legal_moves = generate_legal_moves(board)
+        zobrist_hash = chess.polyglot.zobrist_hash(board)
+        position_id = self.writer.find_position(zobrist_hash, self.is_white)
+        if position_id is None:
+            position_features = None
+            if self.cache is not None:
+                position_features = self.cache.get(zobrist_hash, self.is_white)
+            if position_features is None:
+                attack_map = AttackMap(board, legal_moves) if self.uses_attack_map else None
+                position_features = extract_all(board, self.is_white, attack_map, self.features)
+                if self.cache is not None:
+                    self.cache.put(zobrist_hash, self.is_white, position_features)
+            position_id = self.writer.add_position(
+                zobrist_hash,
+                self.is_white,
+                board.fen(),
+                [position_features[name] for name in self.columns],
+            )
+
+        if self.sampler is None:
+            self.writer.add_moves(position_id, legal_moves, move)
+        else:
+            sampled = self.sampler.sample(board.fen(), legal_moves, move)
+            self.writer.add_moves(
+                position_id,
+                [legal_move for legal_move, _ in sampled],
+                move,
+                [sample_weight for _, sample_weight in sampled],
+            )
+
+    def end_game(self):
+        pass
+
+
+# Writes the board tensors and candidate moves of every position after the
+# opening to a TensorWriter, the same positions FeatureRowWriter writes
+class TensorRowWriter:
+    def __init__(self, writer, player_name):
+        self.writer = writer
+        self.player_name = player_name
+
+    def start_game(self, game):
+        self.is_white = is_player_white(game, self.player_name)
+        return True
+
+    def move(self, board, move, ply):
+        # Skip the first 10 moves (opening phase)
+        if ply <= max_number_opening_moves:
+            return
+        self.writer.add_position(board, self.is_white, generate_legal_moves(board), move)
+
+    def end_game(self):
+        pass
+
+
+# Routes each game to the consumers of every listed player taking part in
+# it, so that many players' datasets come out of one pass over a shared dump
+class PlayerRouter:
+    def __init__(self, consumers_by_player):
+        self.consumers_by_player = consumers_by_player
+        self.active_consumers = []
+
+    def start_game(self, game):
+        players = {
+            game.headers.get("White", "").split(",")[0],
+            game.headers.get("Black", "").split(",")[0],
+        }
+        self.active_consumers = [
+            consumer
+            for player in players
+            for consumer in self.consumers_by_player.get(player, ())
+            if consumer.start_game(game)
         ]
-    )
-    pbar = tqdm(desc="Extracting features", unit=" games")
+        return bool(self.active_consumers)
+
+    def move(self, board, move, ply):
+        for consumer in self.active_consumers:
+            consumer.move(board, move, ply)
+
+    def end_game(self):
+        for consumer in self.active_consumers:
+            consumer.end_game()
+
+
+# Replay a game's mainline once and hand every ply to the consumers that
+# want the game. Consumers implement start_game(game) -> bool,
+# move(board, move, ply) with the board before the move, and end_game().
+def process_game(game, consumers):
+    active_consumers = [consumer for consumer in consumers if consumer.start_game(game)]
+    if not active_consumers:
+        return
+
+    board = game.board()
+    for ply, move in enumerate(game.mainline_moves(), start=1):
+        for consumer in active_consumers:
+            consumer.move(board, move, ply)
+        board.push(move)
+
+    for consumer in active_consumers:
+        consumer.end_game()
+
+
+# Feed every game of a PGN stream to the consumers, returning the number of
+# games. after_game(pgn, game) is called once each game is processed.
+def process_pgn(pgn, consumers, pbar=None, after_game=None):
+    num_of_games = 0
     while True:
         game = chess.pgn.read_game(pgn)
 
-        pbar.update(1)
+        if pbar is not None:
+            pbar.update(1)
+
+        if game is None:
+            break
+
+        num_of_games += 1
+        process_game(game, consumers)
+        if after_game is not None:
+            after_game(pgn, game)
+    return num_of_games
+
 
+# Feed the games starting at the given byte offsets of a PGN file to the consumers
+def process_pgn_offsets(pgn, offsets, consumers, pbar=None, after_game=None):
+    for offset in offsets:
+        game = read_game_at(pgn, offset)
+        process_game(game, consumers)
+        if after_game is not None:
+            after_game(pgn, game)
+
+        if pbar is not None:
+            pbar.update(1)
+    return len(offsets)
+
+
+# Feed the games of a PGN stream to the consumers like process_pgn, with
+# parsing, the consumers and writing each running in their own thread. The
+# stages are connected by queues of at most queue_size games, so a slow
+# stage holds back the ones before it and memory use does not grow with the
+# input. The rows the consumers collect in row_collector are passed to
+# write_rows a game at a time.
+def stream_pgn(pgn, consumers, row_collector, write_rows, pbar=None, queue_size=16):
+    games = queue.Queue(maxsize=queue_size)
+    batches = queue.Queue(maxsize=queue_size)
+    write_errors = []
+
+    def parse():
+        try:
+            while True:
+                game = chess.pgn.read_game(pgn)
+                games.put(game)
+                if game is None:
+                    return
+        except Exception as error:
+            games.put(error)
+
+    def write():
+        while True:
+            rows = batches.get()
+            if rows is None:
+                return
+            # After an error keep taking batches so that the consumers
+            # never block on a full queue
+            if not write_errors:
+                try:
+                    write_rows(rows)
+                except Exception as error:
+                    write_errors.append(error)
+
+    threading.Thread(target=parse, daemon=True).start()
+    writer_thread = threading.Thread(target=write, daemon=True)
+    writer_thread.start()
+
+    num_of_games = 0
+    while not write_errors:
+        game = games.get()
+        if isinstance(game, Exception):
+            raise game
         if game is None:
             break
 
+        process_game(game, consumers)
+        batches.put(row_collector.rows)
+        row_collector.rows = []
         num_of_games += 1
-        num_of_moves = 0
-        is_white = is_player_white(game, player_name)
-
-        board = game.board()
-        for move in game.mainline_moves():
-            num_of_moves += 1
-
-            # Skip the first 10 moves (opening phase)
-            if num_of_moves <= max_number_opening_moves:
-                board.push(move)
-                continue
-
-            fen = board.fen()
-            legal_moves = list(board.legal_moves)
-            material_balance_features = material_balance(board)
-            king_safety_features = king_safety(board)
-            pawn_structure_features = pawn_structure(board)
-            semi_open_files_features = semi_open_files(board)
-            piece_mobility_features = piece_mobility(board)
-            piece_activity_features = piece_activity(board)
-            king_activity_endgame_features = king_activity_endgame(board)
-            threats_features = threats(board)
-            bishop_pair_features = bishop_pair(board)
-            pawn_majority_features = pawn_majority(board)
-
-            for legal_move in legal_moves:
-                simulated_board = board.copy()
-                simulated_board.push(legal_move)
-                # Get feature values for the current board state
-                features = [
-                    1 if is_white else 0,
-                    fen,
-                    legal_move.uci(),  # move in UCI notation
-                    material_balance_features["white_material"],
-                    material_balance_features["black_material"],
-                    material_imbalance(board),  # Material imbalance
-                    minor_piece_imbalance(board),  # Minor piece imbalance
-                    king_safety_features[
-                        "white_king_castled"
-                    ],  # White king castled status
-                    king_safety_features[
-                        "black_king_castled"
-                    ],  # Black king castled status
-                    pawn_structure_features["white_isolated_pawns"],
-                    pawn_structure_features["white_backward_pawns"],
-                    pawn_structure_features["white_passed_pawns"],
-                    pawn_structure_features["black_isolated_pawns"],
-                    pawn_structure_features["black_backward_pawns"],
-                    pawn_structure_features["black_passed_pawns"],
-                    center_control(board, is_white),  # Center control
-                    open_files(board),  # Open files
-                    semi_open_files_features["white_semi_open_files"],
-                    semi_open_files_features["black_semi_open_files"],
-                    piece_mobility_features["white_piece_mobility"],
-                    piece_mobility_features["black_piece_mobility"],
-                    piece_activity_features["white_piece_activity"],
-                    piece_activity_features["black_piece_activity"],
-                    king_activity_endgame_features["white_king_dist_to_center"],
-                    king_activity_endgame_features["black_king_dist_to_center"],
-                    threats_features["white_attacking_pieces"],
-                    threats_features["white_hanging_pieces"],
-                    threats_features["black_attacking_pieces"],
-                    threats_features["black_hanging_pieces"],
-                    space_advantage(board, is_white),  # Space advantage
-                    bishop_pair_features["white_bishop_pair"],
-                    bishop_pair_features["black_bishop_pair"],
-                    knight_outposts(board, is_white),  # Number of knight outposts
-                    rook_on_seventh_rank(board),  # Number of rooks on seventh rank
-                    pawn_majority_features[
-                        "white_pawn_majority"
-                    ],  # White pawn majority
-                    pawn_majority_features[
-                        "black_pawn_majority"
-                    ],  # Black pawn majority
-                    passed_pawn_advancement(board, is_white),  # Passed pawn advancement
+        if pbar is not None:
+            pbar.update(1)
+
+    batches.put(None)
+    writer_thread.join()
+    if write_errors:
+        raise write_errors[0]
+    return num_of_games
+
+
+#Create polyglot opening book, or with update=True add the games of
+#pgn_file to an existing output_book
+def create_player_opening_book(pgn_file, output_book, max_moves=10, update=False):
+    player_name = extract_player_name_from_filename(pgn_file)
+    book_builder = OpeningBookBuilder(player_name, max_moves)
+    pbar = tqdm(desc="Creating opening book: ", unit=" games")
+
+    # Parse PGN file
+    with open_pgn(pgn_file) as f:
+        process_pgn(f, [book_builder], pbar)
+
+    book_builder.write(output_book, existing_books(output_book, update))
+    pbar.close()
+
+
+# The book to add new games to when updating, if it exists yet
+def existing_books(output_book, update):
+    if update and os.path.exists(output_book):
+        return [output_book]
+    return []
+
+
+# Split a PGN file at game boundaries into about num_shards byte ranges
+def split_pgn(pgn_file, num_shards):
+    file_size = os.path.getsize(pgn_file)
+    shard_size = file_size / num_shards
+    shards = []
+    start = 0
+    for entry in load_index(pgn_file):
+        offset = entry["offset"]
+        if offset - start >= shard_size:
+            shards.append((start, offset))
+            start = offset
+    shards.append((start, file_size))
+    return shards
+
+
+# Keeps written rows in a list, to send them from a worker process to the
+# process writing the output
+class RowCollector:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+
+# Extract the rows and opening book moves of one shard of a PGN file, run in
+# a worker process. A shard is either a byte range or, when offsets is not
+# None, the games starting at those byte offsets. Returns the rows, the book
+# move frequencies, the number of games, their Site headers and the hits and
+# misses of the worker's feature cache.
+def extract_shard(task):
+    pgn_file, start, end, offsets, player_name, after_move, features, sampler, cache_file = task
+    rows = []
+    cache = None
+    if cache_file is not None:
+        cache = FeatureCache(cache_file, features)
+    row_writer = FeatureRowWriter(
+        RowCollector(rows), player_name, after_move, features, sampler, cache
+    )
+    book_builder = OpeningBookBuilder(player_name, max_entries=None)
+    processed_ids = []
+
+    def after_game(pgn, game):
+        processed_ids.append(game.headers.get("Site", ""))
+
+    if offsets is not None:
+        with open(pgn_file) as pgn:
+            num_of_games = process_pgn_offsets(
+                pgn, offsets, [book_builder, row_writer], after_game=after_game
+            )
+    else:
+        with open(pgn_file, "rb") as pgn:
+            pgn.seek(start)
+            data = pgn.read(end - start)
+
+        # Decode the same way open(pgn_file) does in a single-process run
+        pgn = io.TextIOWrapper(io.BytesIO(data))
+        num_of_games = process_pgn(pgn, [book_builder, row_writer], after_game=after_game)
+
+    cache_counts = (0, 0)
+    if cache is not None:
+        cache.close()
+        cache_counts = (cache.hits, cache.misses)
+    return rows, book_builder.counts, num_of_games, processed_ids, cache_counts
+
+
+# Extract the games of several players in one pass, writing <player>.csv and
+# <player>.bin for each of them into output_dir
+def extract_players(
+    pgn_file,
+    output_dir,
+    players,
+    offsets=None,
+    after_move=False,
+    features=None,
+    sampler=None,
+    cache=None,
+    profiler=None,
+):
+    os.makedirs(output_dir, exist_ok=True)
+    csv_files = {}
+    row_writers = {}
+    book_builders = {}
+    consumers_by_player = {}
+    for player in players:
+        csv_files[player] = open(os.path.join(output_dir, f"{player}.csv"), "w", newline="")
+        csv_writer = csv.writer(csv_files[player])
+        row_writers[player] = FeatureRowWriter(
+            csv_writer, player, after_move, features, sampler, cache
+        )
+        csv_writer.writerow(csv_header(row_writers[player].columns, sampler is not None))
+        if profiler is not None:
+            row_writers[player].writer = TimedWriter(csv_writer, profiler)
+        book_builders[player] = OpeningBookBuilder(player)
+        if profiler is not None:
+            profiler.instrument(book_builders[player], {"book": "move"})
+        consumers_by_player[player] = [book_builders[player], row_writers[player]]
+
+    router = PlayerRouter(consumers_by_player)
+    pbar = tqdm(desc="Extracting features", unit=" games")
+    try:
+        with open_pgn(pgn_file) as pgn:
+            if offsets is not None:
+                num_of_games = process_pgn_offsets(pgn, offsets, [router], pbar)
+            else:
+                num_of_games = process_pgn(pgn, [router], pbar)
+    finally:
+        pbar.close()
+        for csv_file in csv_files.values():
+            csv_file.close()
+
+    for player in players:
+        book_builders[player].write(os.path.join(output_dir, f"{player}.bin"))
+
+    print("Finished extracting features")
+    for player in players:
+        print(f"{player}: {row_writers[player].num_of_rows} positions")
+    print(f"Number of games: {num_of_games}")
+    print(f"Extracted features from {pgn_file} to {output_dir}")
+    return num_of_games
+
+
+# (shard, num_of_shards) of a --shard I/N argument
+def shard_spec(value):
+    shard, _, num_of_shards = value.partition("/")
+    try:
+        shard, num_of_shards = int(shard), int(num_of_shards)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected I/N, got {value!r}")
+    if not 0 <= shard < num_of_shards:
+        raise argparse.ArgumentTypeError(f"shard {shard} is not in 0..{num_of_shards - 1}")
+    return shard, num_of_shards
+
+
+# Opening book of the player, one per shard when extracting a shard so that
+# runs on one machine do not write the same file
+def player_book_file(player_name, shard=None):
+    if shard is None:
+        return f"{player_name}.bin"
+    return f"{player_name}.shard-{shard[0]}-of-{shard[1]}.bin"
+
+
+# Names in a comma-separated command line list
+def split_names(names):
+    return [name.strip() for name in names.split(",") if name.strip()]
+
+
+# Extract from a PGN file or stdin ("-") to a CSV file or stdout ("-") in
+# one streaming pass, writing the opening book once the input ends.
+# Messages go to stderr so that stdout only carries rows.
+def stream_extraction(
+    pgn_file,
+    output_file,
+    player_name,
+    after_move=False,
+    features=None,
+    sampler=None,
+    update_book=False,
+    cache=None,
+):
+    book_builder = OpeningBookBuilder(player_name)
+    row_collector = RowCollector([])
+    row_writer = FeatureRowWriter(
+        row_collector, player_name, after_move, features, sampler, cache
+    )
+
+    pgn = sys.stdin if pgn_file == "-" else open_pgn(pgn_file)
+    output = sys.stdout if output_file == "-" else open(output_file, "w", newline="")
+    csv_writer = csv.writer(output)
+
+    def write_rows(rows):
+        csv_writer.writerows(rows)
+        output.flush()
+
+    pbar = tqdm(desc="Extracting features", unit=" games")
+    try:
+        write_rows([csv_header(row_writer.columns, sampler is not None)])
+        num_of_games = stream_pgn(pgn, [book_builder, row_writer], row_collector, write_rows, pbar)
+    except BrokenPipeError:
+        # The reader of stdout went away; stop without a traceback and
+        # without writing the book of an incomplete extraction
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        pbar.close()
+        if pgn is not sys.stdin:
+            pgn.close()
+        if output is not sys.stdout:
+            output.close()
+
+    output_book = f"{player_name}.bin"
+    with contextlib.redirect_stdout(sys.stderr):
+        book_builder.write(output_book, existing_books(output_book, update_book))
+
+    print("Finished extracting features", file=sys.stderr)
+    print(f"Number of positions: {row_writer.num_of_rows}", file=sys.stderr)
+    print(f"Number of games: {num_of_games}", file=sys.stderr)
+
+
+# Header row of an existing CSV output
+def read_csv_header(csv_file):
+    with open(csv_file, newline="") as f:
+        return next(csv.reader(f), [])
+
+
+# Print how many positions the feature cache answered, and store its new
+# entries
+def report_cache(cache, file=None):
+    if cache is None:
+        return
+    cache.close()
+    print(f"Feature cache: {cache.hits} hits, {cache.misses} misses", file=file)
+
+
+# Print the --profile summary table and save it as JSON
+def report_profile(profiler, json_file):
+    if profiler is None:
+        return
+    profiler.restore()
+    print(profiler.format_table())
+    profiler.write_json(json_file)
+    print(f"Profile written to {json_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert PGN file to csv file of features for each possible position of every game in the file")
+    parser.add_argument("input_file", type=str, help="The path to the input PGN file, optionally compressed (.gz, .bz2, .xz, .zst), or - to stream from stdin")
+    parser.add_argument("output_file", type=str, help="The path to the output csv file, directory for --format columnar/normalized, or - to stream to stdout")
+    parser.add_argument(
+        "--player",
+        type=str,
+        help="The player whose moves are labelled and whose opening book is built "
+        "(default: the PGN file name; required when reading stdin)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["csv", "columnar", "normalized"],
+        default="csv",
+        help="csv writes one text row per move; columnar writes memory-mappable fixed-width .npy columns; "
+        "normalized writes each distinct position once with a separate table of candidate moves",
+    )
+    parser.add_argument(
+        "--after-move",
+        action="store_true",
+        help="Write the features of the position after each candidate move instead of the position before it",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes extracting features from shards of the PGN file",
+    )
+
+    # Game filters, answered from the PGN's header index without parsing moves
+    parser.add_argument(
+        "--player-games-only",
+        action="store_true",
+        help="Only extract games played by the player named after the PGN file",
+    )
+    parser.add_argument("--min-elo", type=int, help="Minimum rating of both players")
+    parser.add_argument("--max-elo", type=int, help="Maximum rating of both players")
+    parser.add_argument(
+        "--time-control",
+        action="append",
+        help="Only extract games with this TimeControl header (can be repeated)",
+    )
+    parser.add_argument("--date-from", type=str, help="First game date to extract (YYYY.MM.DD)")
+    parser.add_argument("--date-to", type=str, help="Last game date to extract (YYYY.MM.DD)")
+    parser.add_argument(
+        "--site",
+        type=str,
+        help="Only extract the game with this Site header (URL or game id)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_spec,
+        metavar="I/N",
+        help="Only extract shard I (0 to N-1) of the games; N runs with the same N cover every game "
+        "exactly once. The book goes to <player>.shard-I-of-N.bin; merge_shards.py combines the outputs",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=["index", "site"],
+        default="index",
+        help="Assign games to shards by position in the file (contiguous ranges, merged outputs keep "
+        "the file order) or by a hash of the Site header",
+    )
+    parser.add_argument(
+        "--update-book",
+        action="store_true",
+        help="Add the games to the existing <player>.bin opening book instead of rebuilding it",
+    )
+
+    # Crash recovery and incremental refreshes of a CSV output
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=0,
+        help="Save a checkpoint to <output>.ckpt every N games",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue from the checkpoint of an interrupted run",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Append rows only for games whose Site is not yet listed in <output>.done, "
+        "and add them to the existing opening book",
+    )
+
+    # Several players from one shared dump
+    parser.add_argument(
+        "--players",
+        type=str,
+        help="Comma-separated player names; writes <player>.csv and <player>.bin for each into the output directory",
+    )
+    parser.add_argument(
+        "--players-file",
+        type=str,
+        help="File with one player name per line, like --players",
+    )
+    parser.add_argument(
+        "--features",
+        type=str,
+        help="Comma-separated features to compute (default all): " + ", ".join(FEATURES),
+    )
+    parser.add_argument(
+        "--exclude-features",
+        type=str,
+        help="Comma-separated features to leave out",
+    )
+
+    # Negative sampling of the candidate moves that were not played
+    parser.add_argument(
+        "--negatives",
+        type=int,
+        help="Write the played move and at most this many sampled other legal moves per position",
+    )
+    parser.add_argument(
+        "--negative-fraction",
+        type=float,
+        help="Write the played move and this fraction (0-1) of the other legal moves per position",
+    )
+    parser.add_argument(
+        "--sample-seed",
+        type=int,
+        default=0,
+        help="Seed of the negative sampling; the sample of a position only depends on it and the position",
+    )
+    parser.add_argument(
+        "--feature-cache",
+        type=str,
+        metavar="SQLITE_FILE",
+        help="Persistent cache of position features keyed by Zobrist hash; "
+        "entries are dropped automatically when the code of a feature changes",
+    )
+    parser.add_argument(
+        "--tensors",
+        type=str,
+        metavar="DIRECTORY",
+        help="Also write board tensors (12x64 piece planes, side to move, castling, en passant) "
+        "and encoded candidate moves of every position as .npy shards into this directory; needs numpy",
+    )
+    parser.add_argument(
+        "--tensor-shard-size",
+        type=int,
+        default=65536,
+        help="Positions per --tensors shard",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        metavar="JSON_FILE",
+        help="Time parsing, move generation, each feature function and writing, and print a summary; "
+        "the summary is also saved as JSON to JSON_FILE (default <output>.profile.json)",
+    )
+    args = parser.parse_args()
+
+    players = []
+    if args.players is not None:
+        players += split_names(args.players)
+    if args.players_file is not None:
+        with open(args.players_file) as f:
+            players += [line.strip() for line in f if line.strip()]
+    players = list(dict.fromkeys(players))
+    if players and (
+        args.format != "csv"
+        or args.workers > 1
+        or args.checkpoint_every
+        or args.resume
+        or args.incremental
+        or args.update_book
+        or args.player_games_only
+    ):
+        parser.error(
+            "--players supports neither other formats, --workers, checkpoints, "
+            "--incremental, --update-book nor --player-games-only"
+        )
+
+    if args.format == "normalized" and (args.after_move or args.workers > 1):
+        parser.error("--format normalized does not support --after-move or --workers")
+    if (args.checkpoint_every or args.resume or args.incremental) and args.format != "csv":
+        parser.error("--checkpoint-every, --resume and --incremental need --format csv")
+    if (args.checkpoint_every or args.resume) and args.workers > 1:
+        parser.error("--checkpoint-every and --resume do not support --workers")
+    if args.profile is not None and args.workers > 1:
+        parser.error("--profile does not support --workers")
+    if args.tensors is not None and (
+        players or args.workers > 1 or args.checkpoint_every or args.resume or args.incremental
+    ):
+        parser.error(
+            "--tensors supports neither --players, --workers, checkpoints nor --incremental"
+        )
+    if args.tensors is not None and tensor_output.numpy is None:
+        parser.error("--tensors needs numpy, see requirements-optional.txt")
+
+    # Compressed input can only be read front to back
+    if is_compressed(args.input_file) and (
+        args.shard is not None
+        or args.workers > 1
+        or args.checkpoint_every
+        or args.resume
+        or args.incremental
+        or args.player_games_only
+        or args.min_elo is not None
+        or args.max_elo is not None
+        or args.time_control is not None
+        or args.date_from is not None
+        or args.date_to is not None
+        or args.site is not None
+    ):
+        parser.error(
+            "compressed input does not support --shard, --workers, checkpoints, --incremental or game filters"
+        )
+
+    try:
+        features = select_features(
+            split_names(args.features) if args.features is not None else None,
+            split_names(args.exclude_features or ""),
+        )
+    except ValueError as error:
+        parser.error(str(error))
+    if not features:
+        parser.error("no features left to compute")
+    if args.shard is not None and args.site is not None:
+        parser.error("--site selects a single game and does not support --shard")
+    columns = feature_columns(features)
+
+    sampler = None
+    if args.negatives is not None and args.negative_fraction is not None:
+        parser.error("use either --negatives or --negative-fraction")
+    if args.negatives is not None:
+        if args.negatives < 0:
+            parser.error("--negatives must not be negative")
+        sampler = NegativeSampler(negatives=args.negatives, seed=args.sample_seed)
+    elif args.negative_fraction is not None:
+        if not 0 <= args.negative_fraction <= 1:
+            parser.error("--negative-fraction must be between 0 and 1")
+        sampler = NegativeSampler(fraction=args.negative_fraction, seed=args.sample_seed)
+    sample_weight = sampler is not None
+
+    cache = None
+    if args.feature_cache is not None:
+        cache = FeatureCache(args.feature_cache, features)
+
+    pgn_file = args.input_file
+    output_file = args.output_file
+    if args.player is not None:
+        player_name = args.player
+    elif pgn_file == "-":
+        parser.error("reading stdin needs --player")
+    else:
+        player_name = extract_player_name_from_filename(pgn_file)
+
+    # Streaming reads the input once, front to back, into a single CSV
+    if pgn_file == "-" or output_file == "-":
+        if (
+            args.format != "csv"
+            or args.workers > 1
+            or args.checkpoint_every
+            or args.resume
+            or args.incremental
+            or players
+            or args.tensors is not None
+            or args.profile is not None
+            or args.shard is not None
+            or args.player_games_only
+            or args.min_elo is not None
+            or args.max_elo is not None
+            or args.time_control is not None
+            or args.date_from is not None
+            or args.date_to is not None
+            or args.site is not None
+        ):
+            parser.error(
+                "streaming from stdin or to stdout only supports --format csv, --player, "
+                "--after-move, feature selection, negative sampling and --update-book"
+            )
+        stream_extraction(
+            pgn_file,
+            output_file,
+            player_name,
+            args.after_move,
+            features,
+            sampler,
+            args.update_book,
+            cache,
+        )
+        report_cache(cache, sys.stderr)
+        return
+
+    # Index entries of the selected games, or None to extract every game. A
+    # shard is taken from the whole file before filtering, so that every
+    # shard applies the same filters to its own games.
+    entries = None
+    if args.shard is not None:
+        entries = shard_entries(load_index(pgn_file), *args.shard, by=args.shard_by)
+    if args.site is not None:
+        entry = find_game(load_index(pgn_file), args.site)
+        if entry is None:
+            parser.error(f"No game with Site {args.site} in {pgn_file}")
+        entries = [entry]
+    elif (
+        args.player_games_only
+        or args.min_elo is not None
+        or args.max_elo is not None
+        or args.time_control is not None
+        or args.date_from is not None
+        or args.date_to is not None
+    ):
+        entries = filter_index(
+            entries if entries is not None else load_index(pgn_file),
+            player_name=player_name if args.player_games_only else None,
+            min_elo=args.min_elo,
+            max_elo=args.max_elo,
+            time_controls=args.time_control,
+            date_from=args.date_from,
+            date_to=args.date_to,
+        )
+
+    # Leave out the games an earlier incremental run already extracted
+    processed_ids = load_processed_ids(output_file) if args.incremental else set()
+    if processed_ids:
+        if entries is None:
+            entries = load_index(pgn_file)
+        entries = [entry for entry in entries if entry["Site"] not in processed_ids]
+
+    # Byte offsets of the selected games, or None to extract every game
+    offsets = None
+    if entries is not None:
+        offsets = [entry["offset"] for entry in entries]
+
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler()
+        instrument_extraction(profiler)
+
+    if players:
+        num_of_games = extract_players(
+            pgn_file,
+            output_file,
+            players,
+            offsets,
+            args.after_move,
+            features,
+            sampler,
+            cache,
+            profiler,
+        )
+        if args.shard is not None:
+            write_shard_info(output_file, *args.shard, args.shard_by, num_of_games)
+        report_cache(cache)
+        report_profile(profiler, args.profile or os.path.join(output_file, "profile.json"))
+        return
+
+    checkpoint = load_checkpoint(output_file) if args.resume else None
+    skipped = 0
+    if checkpoint is not None:
+        # Drop the rows written after the checkpoint; an incremental run's
+        # selection already leaves out the games done before it
+        os.truncate(output_file, checkpoint["output_size"])
+        if offsets is not None and not args.incremental:
+            skipped = checkpoint["selection_done"]
+            offsets = offsets[skipped:]
+
+    num_of_games = 0
+    num_of_positions = 0
+    print(f"Opening files...")
+
+    book_builder = OpeningBookBuilder(player_name)
+    if profiler is not None:
+        profiler.instrument(book_builder, {"book": "move"})
+
+    # Store fen positions with features after opening, building the opening
+    # book from the same parse
+    if args.format == "columnar":
+        output = ColumnarWriter(
+            output_file, feature_columns=columns, sample_weight=sample_weight
+        )
+        writer = output
+    elif args.format == "normalized":
+        output = NormalizedWriter(output_file, columns, sample_weight)
+        writer = output
+    elif checkpoint is not None or (args.incremental and os.path.exists(output_file)):
+        if read_csv_header(output_file) != csv_header(columns, sample_weight):
+            parser.error(f"{output_file} was written with other features or sampling")
+        output = open(output_file, "a", newline="")
+        writer = csv.writer(output)
+    else:
+        output = open(output_file, "w", newline="")
+        writer = csv.writer(output)
+        writer.writerow(csv_header(columns, sample_weight))
+
+    checkpointer = None
+    if args.checkpoint_every or args.resume or args.incremental:
+        checkpointer = Checkpointer(
+            output_file,
+            output,
+            book_builder,
+            every=args.checkpoint_every,
+            record_ids=args.incremental,
+            checkpoint=checkpoint,
+            skipped=skipped,
+        )
+        if checkpoint is None:
+            checkpointer.begin()
+
+    with output:
+        pbar = tqdm(desc="Extracting features", unit=" games")
+
+        if args.workers > 1:
+            # Several shards per worker keep the pool busy when game sizes vary;
+            # imap hands the results back in shard order
+            num_of_shards = args.workers * 8
+            if offsets is not None:
+                shard_size = max(1, -(-len(offsets) // num_of_shards))
+                tasks = [
                     (
-                        1 if legal_move == move else 0
-                    ),  # label (1 if the move is actually made, 0 otherwise)
+                        pgn_file,
+                        None,
+                        None,
+                        offsets[i : i + shard_size],
+                        player_name,
+                        args.after_move,
+                        features,
+                        sampler,
+                        args.feature_cache,
+                    )
+                    for i in range(0, len(offsets), shard_size)
                 ]
+            else:
+                tasks = [
+                    (
+                        pgn_file,
+                        start,
+                        end,
+                        None,
+                        player_name,
+                        args.after_move,
+                        features,
+                        sampler,
+                        args.feature_cache,
+                    )
+                    for start, end in split_pgn(pgn_file, num_of_shards)
+                ]
+            with Pool(args.workers) as pool:
+                for rows, book_counts, shard_games, shard_ids, cache_counts in pool.imap(
+                    extract_shard, tasks
+                ):
+                    writer.writerows(rows)
+                    book_builder.merge(book_counts)
+                    num_of_games += shard_games
+                    num_of_positions += len(rows)
+                    pbar.update(shard_games)
+                    if checkpointer is not None:
+                        checkpointer.pending_ids.extend(shard_ids)
+                    if cache is not None:
+                        cache.hits += cache_counts[0]
+                        cache.misses += cache_counts[1]
+        else:
+            if profiler is not None:
+                if args.format == "normalized":
+                    profiler.instrument(writer, {"write": "add_moves", "write.position": "add_position"})
+                else:
+                    writer = TimedWriter(writer, profiler)
+
+            if args.format == "normalized":
+                row_writer = NormalizedRowWriter(writer, player_name, features, sampler, cache)
+            else:
+                row_writer = FeatureRowWriter(
+                    writer, player_name, args.after_move, features, sampler, cache
+                )
+            consumers = [book_builder, row_writer]
+
+            tensor_writer = None
+            if args.tensors is not None:
+                tensor_writer = TensorWriter(args.tensors, args.tensor_shard_size)
+                if profiler is not None:
+                    profiler.instrument(
+                        tensor_writer, {"tensors": "add_position", "tensors.flush": "flush"}
+                    )
+                consumers.append(TensorRowWriter(tensor_writer, player_name))
+
+            after_game = None
+            if checkpointer is not None:
+                def after_game(pgn, game):
+                    checkpointer.game_done(pgn, game, row_writer.num_of_rows)
+
+            with open_pgn(pgn_file) as pgn:
+                if offsets is not None:
+                    num_of_games = process_pgn_offsets(
+                        pgn, offsets, consumers, pbar, after_game
+                    )
+                else:
+                    if checkpoint is not None:
+                        pgn.seek(checkpoint["pgn_offset"])
+                    num_of_games = process_pgn(pgn, consumers, pbar, after_game)
+            num_of_positions = row_writer.num_of_rows
+            if tensor_writer is not None:
+                tensor_writer.close()
+        pbar.close()
+
+    if checkpointer is not None:
+        num_of_games += checkpointer.base_games
+        num_of_positions += checkpointer.base_rows
+
+    output_book = player_book_file(player_name, args.shard)
+    book_builder.write(
+        output_book, existing_books(output_book, args.update_book or bool(processed_ids))
+    )
+    if checkpointer is not None:
+        checkpointer.finish()
+    if args.shard is not None:
+        write_shard_info(output_file, *args.shard, args.shard_by, num_of_games)
+        if args.tensors is not None:
+            write_shard_info(args.tensors, *args.shard, args.shard_by, num_of_games)
+
+    print("Finished extracting features")
+    print(f"Number of positions: {num_of_positions}")
+    print(f"Number of games: {num_of_games}")
+    print(f"Extracted features from {pgn_file} to {output_file}")
+    report_cache(cache)
+    report_profile(profiler, args.profile or output_file + ".profile.json")
+
 
-                # Write the data to the CSV
-                csv_writer.writerow(features)
-                num_of_positions += 1
-                simulated_board.pop()
-
-            board.push(move)
-pbar.close()
-print("Finished extracting features")
-print(f"Number of positions: {num_of_positions}")
-print(f"Number of games: {num_of_games}")
-print(f"Extracted features from {pgn_file} to {output_file}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import argparse
+import array
+import csv
+import json
+import os
+import shutil
+
+from columnar_output import NPY_HEADER_SIZE, POSITIONS_FILE as COLUMNAR_POSITIONS_FILE, _npy_header
+from normalized_output import MOVES_FILE, POSITIONS_FILE as NORMALIZED_POSITIONS_FILE
+from opening_book import merge_books
+from tensor_output import MOVE_ARRAYS, POSITION_ARRAYS, shard_file
+
+
+SCHEMA_FILE = "schema.json"
+
+# Typecodes of the array module for the numpy dtypes of columnar outputs
+ARRAY_TYPECODES = {"u1": "B", "i1": "b", "u2": "H", "i2": "h", "i4": "i", "f4": "f"}
+
+
+# Sidecar file describing which shard of the input an output holds
+def shard_info_file_for(output_file):
+    return output_file.rstrip("/") + ".shard.json"
+
+
+def write_shard_info(output_file, shard, num_of_shards, by, num_of_games):
+    with open(shard_info_file_for(output_file), "w") as f:
+        json.dump(
+            {"shard": shard, "num_of_shards": num_of_shards, "by": by, "games": num_of_games},
+            f,
+            indent=2,
+        )
+
+
+# Shard info of an output, or of the --players directory holding it; None
+# when the output was not written with --shard
+def read_shard_info(path):
+    for candidate in (path, os.path.dirname(os.path.abspath(path))):
+        info_file = shard_info_file_for(candidate)
+        if os.path.exists(info_file):
+            with open(info_file) as f:
+                return json.load(f)
+    return None
+
+
+# Inputs in shard order, checking that they are all the shards of one
+# split. Inputs written without --shard are merged in the given order.
+def order_inputs(inputs):
+    infos = [read_shard_info(path) for path in inputs]
+    if all(info is None for info in infos):
+        return inputs
+    if any(info is None for info in infos):
+        missing = [path for path, info in zip(inputs, infos) if info is None]
+        raise ValueError(f"No shard info for {', '.join(missing)}")
+
+    splits = {(info["num_of_shards"], info["by"]) for info in infos}
+    if len(splits) > 1:
+        raise ValueError("The inputs are shards of different splits")
+    num_of_shards = infos[0]["num_of_shards"]
+    shards = sorted(info["shard"] for info in infos)
+    if shards != list(range(num_of_shards)):
+        missing = sorted(set(range(num_of_shards)) - set(shards))
+        duplicates = sorted({shard for shard in shards if shards.count(shard) > 1})
+        raise ValueError(f"Incomplete shards: missing {missing}, duplicated {duplicates}")
+    return [path for _, path in sorted(zip((info["shard"] for info in infos), inputs))]
+
+
+# CSV outputs: the header once, then the rows of every input
+def merge_csv(inputs, output_file):
+    header = None
+    num_of_rows = 0
+    with open(output_file, "wb") as output:
+        for path in inputs:
+            with open(path, "rb") as f:
+                input_header = f.readline()
+                if header is None:
+                    header = input_header
+                    output.write(header)
+                elif input_header != header:
+                    raise ValueError(f"{path} has other columns than {inputs[0]}")
+                while True:
+                    data = f.read(1 << 20)
+                    if not data:
+                        break
+                    output.write(data)
+                    num_of_rows += data.count(b"\n")
+    return num_of_rows
+
+
+def _read_schema(directory):
+    with open(os.path.join(directory, SCHEMA_FILE)) as f:
+        return json.load(f)
+
+
+# Columnar outputs: every column file and positions.txt concatenated, the
+# position column shifted by the positions before each input. As in a
+# single run, a position repeated right across two inputs is listed once.
+def merge_columnar(inputs, output_dir):
+    schemas = [_read_schema(path) for path in inputs]
+    if any(schema["columns"] != schemas[0]["columns"] for schema in schemas):
+        raise ValueError(f"The inputs have other columns than {inputs[0]}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Position ids of every input's first line in the merged positions file
+    position_offsets = []
+    num_of_positions = 0
+    last_fen = None
+    with open(os.path.join(output_dir, COLUMNAR_POSITIONS_FILE), "w") as output:
+        for path in inputs:
+            with open(os.path.join(path, COLUMNAR_POSITIONS_FILE)) as f:
+                first_fen = f.readline()
+                if first_fen and first_fen == last_fen:
+                    position_offsets.append(num_of_positions - 1)
+                elif first_fen:
+                    position_offsets.append(num_of_positions)
+                    output.write(first_fen)
+                    num_of_positions += 1
+                else:
+                    position_offsets.append(num_of_positions)
+                last_fen = first_fen or last_fen
+                for fen in f:
+                    output.write(fen)
+                    num_of_positions += 1
+                    last_fen = fen
+
+    num_of_rows = sum(schema["num_rows"] for schema in schemas)
+    for column in schemas[0]["columns"]:
+        dtype = column["dtype"]
+        typecode = ARRAY_TYPECODES[dtype[1:]]
+        with open(os.path.join(output_dir, column["file"]), "wb") as output:
+            output.write(_npy_header(dtype, num_of_rows))
+            for path, position_offset in zip(inputs, position_offsets):
+                with open(os.path.join(path, column["file"]), "rb") as f:
+                    f.seek(NPY_HEADER_SIZE)
+                    if column["name"] != "position":
+                        shutil.copyfileobj(f, output)
+                        continue
+                    while True:
+                        values = array.array(typecode)
+                        data = f.read(1 << 20)
+                        if not data:
+                            break
+                        values.frombytes(data)
+                        array.array(typecode, (value + position_offset for value in values)).tofile(output)
+
+    schema = dict(schemas[0], num_rows=num_of_rows, num_positions=num_of_positions)
+    with open(os.path.join(output_dir, SCHEMA_FILE), "w") as f:
+        json.dump(schema, f, indent=2)
+    return num_of_rows
+
+
+# Normalized outputs: positions seen in several inputs are merged into one
+# with the sum of their occurrences, numbered by first occurrence, and the
+# moves are rewritten with the merged position ids
+def merge_normalized(inputs, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    position_ids = {}
+    positions = []
+    positions_header = None
+    moves_header = None
+    num_of_rows = 0
+
+    with open(os.path.join(output_dir, MOVES_FILE), "w", newline="") as moves_output:
+        moves_writer = csv.writer(moves_output)
+        for path in inputs:
+            ids = {}
+            with open(os.path.join(path, NORMALIZED_POSITIONS_FILE), newline="") as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                if positions_header is None:
+                    positions_header = header
+                elif header != positions_header:
+                    raise ValueError(f"{path} has other columns than {inputs[0]}")
+                for row in reader:
+                    key = (row[1], row[2])
+                    if key in position_ids:
+                        position = positions[position_ids[key]]
+                        position[4] = str(int(position[4]) + int(row[4]))
+                    else:
+                        position_ids[key] = len(positions)
+                        positions.append([str(len(positions))] + row[1:])
+                    ids[row[0]] = position_ids[key]
+
+            with open(os.path.join(path, MOVES_FILE), newline="") as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                if moves_header is None:
+                    moves_header = header
+                    moves_writer.writerow(header)
+                elif header != moves_header:
+                    raise ValueError(f"{path} has other columns than {inputs[0]}")
+                for row in reader:
+                    row[0] = ids[row[0]]
+                    moves_writer.writerow(row)
+                    num_of_rows += 1
+
+    with open(os.path.join(output_dir, NORMALIZED_POSITIONS_FILE), "w", newline="") as f:
+        positions_writer = csv.writer(f)
+        positions_writer.writerow(positions_header)
+        positions_writer.writerows(positions)
+    return num_of_rows
+
+
+# Tensor outputs: the shards of every input renumbered one after another
+def merge_tensors(inputs, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    schemas = [_read_schema(path) for path in inputs]
+    shards = []
+    for path, schema in zip(inputs, schemas):
+        for index, shard in enumerate(schema["shards"]):
+            for name in list(POSITION_ARRAYS) + list(MOVE_ARRAYS):
+                shutil.copyfile(shard_file(path, name, index), shard_file(output_dir, name, len(shards)))
+            shards.append(shard)
+
+    schema = dict(schemas[0], shards=shards)
+    with open(os.path.join(output_dir, SCHEMA_FILE), "w") as f:
+        json.dump(schema, f, indent=2)
+    return sum(shard["moves"] for shard in shards)
+
+
+# Kind of an extraction output: book, csv, columnar, normalized or tensors
+def output_kind(path):
+    if not os.path.isdir(path):
+        return "book" if path.endswith(".bin") else "csv"
+    if os.path.exists(os.path.join(path, MOVES_FILE)):
+        return "normalized"
+    return "tensors" if "shards" in _read_schema(path) else "columnar"
+
+
+def merge_outputs(inputs, output):
+    kinds = {output_kind(path) for path in inputs}
+    if len(kinds) > 1:
+        raise ValueError(f"Cannot merge different kinds of outputs: {', '.join(sorted(kinds))}")
+    kind = kinds.pop()
+
+    # Book weights are summed, so their order does not matter
+    if kind == "book":
+        merge_books(inputs, output)
+        return kind, None
+
+    merge = {
+        "csv": merge_csv,
+        "columnar": merge_columnar,
+        "normalized": merge_normalized,
+        "tensors": merge_tensors,
+    }[kind]
+    return kind, merge(order_inputs(inputs), output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge the outputs of main.py --shard runs: CSV files and columnar, normalized "
+        "or tensor directories are concatenated in shard order, opening books have their weights summed",
+        epilog="Example: for i in 0 1 2 3; do python main.py --shard $i/4 games.pgn out.$i.csv & done; wait; "
+        "python merge_shards.py out.csv out.*.csv; python merge_shards.py games.bin games.shard-*.bin",
+    )
+    parser.add_argument("output", type=str, help="The path to the merged output")
+    parser.add_argument("inputs", type=str, nargs="+", help="The shard outputs to merge, all of one kind")
+    args = parser.parse_args()
+
+    if args.output in args.inputs:
+        parser.error("the output must not be one of the inputs")
+    try:
+        kind, num_of_rows = merge_outputs(args.inputs, args.output)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if kind == "book":
+        print(f"Polyglot book created: {args.output}")
+    else:
+        print(f"Merged {len(args.inputs)} {kind} outputs into {args.output}: {num_of_rows} rows")
@@ -0,0 +1,286 @@
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import chess
+
+from extract_features import (
+    FEATURE_NAMES,
+    FEATURES,
+    AttackMap,
+    extract_after_move,
+    extract_all,
+    feature_columns,
+    required_intermediates,
+)
+from opening_book import PlayerBook
+from profiler import StageStats
+from uci_position import board_from_request, board_from_uci_position
+
+
+# Linear model scoring the candidate moves of a position from the features
+# of the position after each move, as in the rows written with
+# --after-move. The model file is JSON, {"intercept": b, "weights":
+# {column: w}}, e.g. the coefficients of a logistic regression fit on those
+# rows; columns are feature columns or is_white_player. Only the features
+# of weighted columns are computed.
+class LinearMoveModel:
+    def __init__(self, weights, intercept=0.0):
+        unknown = set(weights) - set(FEATURE_NAMES) - {"is_white_player"}
+        if unknown:
+            raise ValueError(f"Unknown model columns: {', '.join(sorted(unknown))}")
+
+        self.intercept = intercept
+        self.features = [
+            name
+            for name, feature in FEATURES.items()
+            if any(column in weights for column in feature.columns)
+        ]
+        self.columns = [column for column in feature_columns(self.features) if column in weights]
+        self.uses_attack_map = "attack_map" in required_intermediates(self.features)
+        self.weights = [weights[column] for column in self.columns]
+        self.white_weight = weights.get("is_white_player", 0.0)
+
+    # Feature rows of all candidate moves at once: the position's features
+    # and attack map are computed a single time and, for each move, only the
+    # features the move can change are recomputed
+    def feature_rows(self, board, legal_moves):
+        is_white = board.turn
+        features = self.features
+        columns = self.columns
+        attack_map = AttackMap(board, legal_moves) if self.uses_attack_map else None
+        parent_features = extract_all(board, is_white, attack_map, features)
+        rows = []
+        for move in legal_moves:
+            values = extract_after_move(board, move, is_white, parent_features, features, attack_map)
+            rows.append([values[column] for column in columns])
+        return rows
+
+    def score_moves(self, board, legal_moves):
+        base = self.intercept + (self.white_weight if board.turn else 0.0)
+        weights = self.weights
+        return [
+            base + sum(weight * value for weight, value in zip(weights, row))
+            for row in self.feature_rows(board, legal_moves)
+        ]
+
+    # (move, probability) pairs by descending probability, the scores of the
+    # moves being normalized with a softmax
+    def move_probabilities(self, board, legal_moves):
+        if not legal_moves:
+            return []
+        scores = self.score_moves(board, legal_moves)
+        best = max(scores)
+        exps = [math.exp(score - best) for score in scores]
+        total = sum(exps)
+        return sorted(
+            ((move, exp / total) for move, exp in zip(legal_moves, exps)),
+            key=lambda candidate: -candidate[1],
+        )
+
+
+def load_model(path):
+    with open(path) as f:
+        model = json.load(f)
+    return LinearMoveModel(model["weights"], model.get("intercept", 0.0))
+
+
+# Predicts the player's move: the book's moves when the position is in the
+# player's book, otherwise the model's scores of every legal move. The
+# latency of every prediction is recorded by source.
+class MovePredictor:
+    def __init__(self, model, book=None):
+        self.model = model
+        self.book = book
+        self.latency = {"book": StageStats(), "model": StageStats()}
+        self.lock = threading.Lock()
+
+    # (source, [(move, probability)]) by descending probability; no
+    # candidates when the game is over
+    def predict(self, board):
+        start = time.perf_counter_ns()
+        candidates = []
+        if self.book is not None:
+            candidates = [
+                (move, probability)
+                for move, probability in self.book.move_distribution(board)
+                if board.is_legal(move)
+            ]
+            # Illegal book moves (hash collisions) dropped, the probabilities
+            # of the others are renormalized to sum to 1
+            total = sum(probability for _, probability in candidates)
+            candidates = sorted(
+                ((move, probability / total) for move, probability in candidates if total),
+                key=lambda candidate: -candidate[1],
+            )
+        source = "book"
+        if not candidates:
+            source = "model"
+            candidates = self.model.move_probabilities(board, list(board.legal_moves))
+
+        elapsed_ns = time.perf_counter_ns() - start
+        with self.lock:
+            self.latency[source].add(elapsed_ns)
+        return source, candidates
+
+    def stats(self):
+        with self.lock:
+            return {source: stats.summary() for source, stats in self.latency.items()}
+
+
+# Answer of a prediction as sent over HTTP
+def prediction_json(source, candidates, elapsed_ns):
+    return {
+        "move": candidates[0][0].uci() if candidates else None,
+        "source": source,
+        "candidates": [
+            {"move": move.uci(), "probability": round(probability, 6)}
+            for move, probability in candidates
+        ],
+        "elapsed_ms": round(elapsed_ns / 1e6, 3),
+    }
+
+
+# Minimal UCI engine: plays the predicted move of the current position on
+# every go, whatever the search limits
+def run_uci(predictor, name, input=sys.stdin, output=sys.stdout):
+    board = chess.Board()
+
+    def send(line):
+        output.write(line + "\n")
+        output.flush()
+
+    for line in input:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+
+        if command == "uci":
+            send(f"id name {name}")
+            send("uciok")
+        elif command == "isready":
+            send("readyok")
+        elif command == "ucinewgame":
+            board = chess.Board()
+        elif command == "position":
+            try:
+                board = board_from_uci_position(tokens[1:])
+            except ValueError as e:
+                send(f"info string invalid position: {e}")
+        elif command == "go":
+            source, candidates = predictor.predict(board)
+            if candidates:
+                move, probability = candidates[0]
+                send(f"info string {source} probability {probability:.4f}")
+                send(f"bestmove {move.uci()}")
+            else:
+                send("bestmove 0000")
+        elif command == "quit":
+            break
+
+
+# POST /move with {"fen": ..., "moves": [...]} (both optional) answers the
+# predicted move with every candidate's probability; GET /stats answers the
+# latency of the predictions made so far, by source
+class MoveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.predictor.stats())
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/move":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("expected a JSON object")
+            fen = request.get("fen")
+            moves = request.get("moves", [])
+            if fen is not None and not isinstance(fen, str):
+                raise ValueError("fen must be a string")
+            if not isinstance(moves, list) or not all(isinstance(move, str) for move in moves):
+                raise ValueError("moves must be a list of UCI strings")
+            board = board_from_request(fen, moves)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        start = time.perf_counter_ns()
+        source, candidates = self.server.predictor.predict(board)
+        self.send_json(200, prediction_json(source, candidates, time.perf_counter_ns() - start))
+
+    # Requests are not logged, to keep latency down
+    def log_message(self, format, *args):
+        pass
+
+
+def make_http_server(predictor, host, port):
+    server = ThreadingHTTPServer((host, port), MoveRequestHandler)
+    server.daemon_threads = True
+    server.predictor = predictor
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the moves a player would play: from the player's opening book when in "
+        "book, otherwise from a model scoring every legal move, as a UCI engine or over HTTP"
+    )
+    parser.add_argument("model_file", type=str, help="The path to the JSON model (intercept and weights by column)")
+    parser.add_argument("--book", type=str, help="The path to the player's polyglot book")
+    parser.add_argument(
+        "--http",
+        type=str,
+        metavar="HOST:PORT",
+        help="Serve JSON over HTTP at this address instead of speaking UCI on stdin/stdout",
+    )
+    parser.add_argument("--name", type=str, help="Engine name sent to UCI clients (default: the model file name)")
+    args = parser.parse_args()
+
+    try:
+        model = load_model(args.model_file)
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(f"cannot load model {args.model_file}: {e}")
+
+    book = PlayerBook(args.book) if args.book else None
+    predictor = MovePredictor(model, book)
+    try:
+        if args.http:
+            host, _, port = args.http.rpartition(":")
+            server = make_http_server(predictor, host or "127.0.0.1", int(port))
+            print(f"Serving moves on http://{host or '127.0.0.1'}:{port}", file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+        else:
+            name = args.name or os.path.splitext(os.path.basename(args.model_file))[0]
+            run_uci(predictor, name)
+    finally:
+        if book is not None:
+            book.close()
+
+
+if __name__ == "__main__":
+    main()
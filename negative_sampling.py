@@ -0,0 +1,38 @@
+import math
+import random
+import zlib
+
+
+# Picks which candidate moves of a position are written: the played move
+# and either `negatives` or a `fraction` of the other legal moves. The
+# sample only depends on the seed and the position, so it is the same in
+# every run, with any number of workers and when resuming. Each kept
+# alternative gets the weight (alternatives / kept alternatives) so that
+# training can correct for the sampling; the played move has weight 1.
+class NegativeSampler:
+    def __init__(self, negatives=None, fraction=None, seed=0):
+        self.negatives = negatives
+        self.fraction = fraction
+        self.seed = seed
+
+    def num_to_keep(self, num_of_negatives):
+        if self.negatives is not None:
+            return min(num_of_negatives, self.negatives)
+        return min(num_of_negatives, math.ceil(self.fraction * num_of_negatives))
+
+    # (move, sample_weight) pairs to write for a position identified by its
+    # FEN, in legal move order
+    def sample(self, fen, legal_moves, played_move):
+        negatives = [index for index, move in enumerate(legal_moves) if move != played_move]
+        num_to_keep = self.num_to_keep(len(negatives))
+        if num_to_keep >= len(negatives):
+            return [(move, 1.0) for move in legal_moves]
+
+        rng = random.Random((self.seed << 32) | zlib.crc32(fen.encode()))
+        kept = set(rng.sample(negatives, num_to_keep))
+        weight = round(len(negatives) / num_to_keep, 6) if num_to_keep else 0.0
+        return [
+            (move, 1.0 if move == played_move else weight)
+            for index, move in enumerate(legal_moves)
+            if index in kept or move == played_move
+        ]
@@ -0,0 +1,83 @@
+import csv
+import os
+
+from extract_features import FEATURE_NAMES
+
+
+POSITIONS_FILE = "positions.csv"
+MOVES_FILE = "moves.csv"
+
+POSITION_COLUMNS = ["position_id", "zobrist_hash", "is_white_player", "position_fen", "occurrences"]
+MOVES_HEADER = ["position_id", "move", "label"]
+
+
+# Writes a positions table with the features of every distinct position
+# (keyed by Zobrist hash and the player's color) and how often it occurred,
+# and a moves table with the candidate moves of every occurrence referencing
+# the position by id. Moves are written as they come; positions are written
+# on close once their occurrence counts are known. feature_values of
+# add_position are the values of the feature_columns. With sample_weight
+# set the moves table has a sample_weight column for negative sampling.
+class NormalizedWriter:
+    def __init__(self, directory, feature_columns=FEATURE_NAMES, sample_weight=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.feature_columns = feature_columns
+        self.position_ids = {}
+        self.positions = []
+        self.num_of_rows = 0
+
+        self.moves_file = open(os.path.join(directory, MOVES_FILE), "w", newline="")
+        self.moves_writer = csv.writer(self.moves_file)
+        self.moves_writer.writerow(MOVES_HEADER + (["sample_weight"] if sample_weight else []))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Id of an already seen position, or None
+    def find_position(self, zobrist_hash, is_white):
+        return self.position_ids.get((zobrist_hash, is_white))
+
+    def add_position(self, zobrist_hash, is_white, fen, feature_values):
+        position_id = len(self.positions)
+        self.position_ids[(zobrist_hash, is_white)] = position_id
+        self.positions.append([zobrist_hash, 1 if is_white else 0, fen, 0, feature_values])
+        return position_id
+
+    # Record one occurrence of a position with its candidate moves, and
+    # their sample weights when the moves were sampled
+    def add_moves(self, position_id, legal_moves, played_move, sample_weights=None):
+        self.positions[position_id][3] += 1
+        if sample_weights is None:
+            for legal_move in legal_moves:
+                self.moves_writer.writerow(
+                    [position_id, legal_move.uci(), 1 if legal_move == played_move else 0]
+                )
+        else:
+            for legal_move, sample_weight in zip(legal_moves, sample_weights):
+                self.moves_writer.writerow(
+                    [
+                        position_id,
+                        legal_move.uci(),
+                        1 if legal_move == played_move else 0,
+                        sample_weight,
+                    ]
+                )
+        self.num_of_rows += len(legal_moves)
+
+    def close(self):
+        self.moves_file.close()
+
+        with open(os.path.join(self.directory, POSITIONS_FILE), "w", newline="") as f:
+            positions_writer = csv.writer(f)
+            positions_writer.writerow(POSITION_COLUMNS + self.feature_columns)
+            for position_id, (zobrist_hash, is_white, fen, occurrences, feature_values) in enumerate(
+                self.positions
+            ):
+                positions_writer.writerow(
+                    [position_id, f"{zobrist_hash:016x}", is_white, fen, occurrences]
+                    + feature_values
+                )
@@ -0,0 +1,397 @@
+import argparse
+import functools
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+
+import chess
+import chess.polyglot
+
+
+# Polyglot book entry: key, raw move, weight, learn
+ENTRY_STRUCT = struct.Struct(">QHHI")
+
+KEY_STRUCT = struct.Struct(">Q")
+
+# Intermediate run entry: key, raw move and a 32-bit count
+RUN_STRUCT = struct.Struct(">QHI")
+
+MAX_WEIGHT = 0xFFFF
+
+# Most runs merged at once, so that a merge never has more files open
+MERGE_FAN_IN = 64
+
+
+# Encode a move of the given board in polyglot format. Castling moves are
+# written as the king capturing its own rook, as polyglot readers expect.
+def polyglot_raw_move(board, move):
+    to_square = move.to_square
+    if board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        if board.is_kingside_castling(move):
+            to_square = chess.square(7, rank)
+        else:
+            to_square = chess.square(0, rank)
+
+    promotion = move.promotion - 1 if move.promotion else 0
+    return to_square | (move.from_square << 6) | (promotion << 12)
+
+
+# Decode a polyglot move for the given board, turning king-takes-rook back
+# into the usual castling move
+def decode_raw_move(board, raw_move):
+    from_square = (raw_move >> 6) & 0x3F
+    to_square = raw_move & 0x3F
+    promotion = (raw_move >> 12) & 0x7
+
+    if board.kings & chess.BB_SQUARES[from_square] and board.rooks & board.occupied_co[
+        board.turn
+    ] & chess.BB_SQUARES[to_square]:
+        rank = chess.square_rank(from_square)
+        to_square = chess.square(6 if to_square > from_square else 2, rank)
+
+    return chess.Move(from_square, to_square, promotion + 1 if promotion else None)
+
+
+def _write_run(counts, run_file):
+    for (key, raw_move), count in sorted(counts.items()):
+        run_file.write(RUN_STRUCT.pack(key, raw_move, count))
+
+
+def _read_run(path):
+    with open(path, "rb") as run_file:
+        while True:
+            data = run_file.read(RUN_STRUCT.size * 4096)
+            if not data:
+                break
+            yield from RUN_STRUCT.iter_unpack(data)
+
+
+# Sum the counts of the same (key, raw_move) in sorted runs
+def _sum_runs(runs):
+    current = None
+    count = 0
+    for key, raw_move, run_count in heapq.merge(*runs):
+        if current == (key, raw_move):
+            count += run_count
+        else:
+            if current is not None:
+                yield current + (count,)
+            current = (key, raw_move)
+            count = run_count
+    if current is not None:
+        yield current + (count,)
+
+
+# Merge sorted runs into a new run file in run_dir, returning its path
+def _merge_to_run(runs, run_dir):
+    run_file = tempfile.NamedTemporaryFile(
+        prefix="book-run-", suffix=".bin", dir=run_dir, delete=False
+    )
+    try:
+        with run_file:
+            for entry in _sum_runs(runs):
+                run_file.write(RUN_STRUCT.pack(*entry))
+    except BaseException:
+        os.remove(run_file.name)
+        raise
+    return run_file.name
+
+
+# Merge (path, read) sources MERGE_FAN_IN at a time into new run files in
+# run_dir until at most max_sources are left, and return those. The paths
+# of merged sources are added to merged, including runs made here and
+# merged again; nothing is removed, so the caller decides what may go.
+# Runs made here are removed when a merge fails.
+def _reduce_sources(sources, max_sources, run_dir, merged):
+    created = []
+    try:
+        while len(sources) > max_sources:
+            group = sources[:MERGE_FAN_IN]
+            run = _merge_to_run([read(path) for path, read in group], run_dir)
+            created.append(run)
+            sources = sources[MERGE_FAN_IN:] + [(run, _read_run)]
+            merged.extend(path for path, _ in group)
+    except BaseException:
+        for run in created:
+            os.remove(run)
+        raise
+    return sources
+
+
+# Read a polyglot book as a sorted run of (key, raw_move, weight). Books keep
+# a position's entries by weight, so each position is re-sorted by move.
+def _read_book(path):
+    current_key = None
+    moves = []
+    with open(path, "rb") as book:
+        while True:
+            data = book.read(ENTRY_STRUCT.size * 4096)
+            if not data:
+                break
+            for key, raw_move, weight, _ in ENTRY_STRUCT.iter_unpack(data):
+                if key != current_key:
+                    moves.sort()
+                    yield from ((current_key, move, count) for move, count in moves)
+                    current_key = key
+                    moves = []
+                moves.append((raw_move, weight))
+    moves.sort()
+    yield from ((current_key, move, count) for move, count in moves)
+
+
+# Scale the counts of one position into 16-bit weights, keeping their ratios
+def _scale_weights(moves):
+    max_count = max(count for _, count in moves)
+    if max_count <= MAX_WEIGHT:
+        return moves
+    return [(raw_move, max(1, count * MAX_WEIGHT // max_count)) for raw_move, count in moves]
+
+
+# Merge sorted runs of (key, raw_move, count), summing counts of the same
+# (key, move), and write them as a polyglot book. Entries of a position are
+# ordered by descending weight. The book is written to a temporary file
+# first so that output_book may also be one of the inputs. All runs are
+# merged at once; callers keep their number within MERGE_FAN_IN.
+def write_merged_runs(runs, output_book):
+    temp_book = output_book + ".tmp"
+    try:
+        with open(temp_book, "wb") as book:
+            current_key = None
+            moves = []
+
+            def write_position():
+                for raw_move, weight in sorted(
+                    _scale_weights(moves), key=lambda move: (-move[1], move[0])
+                ):
+                    book.write(ENTRY_STRUCT.pack(current_key, raw_move, weight, 0))
+
+            for key, raw_move, count in _sum_runs(runs):
+                if key != current_key:
+                    if moves:
+                        write_position()
+                    current_key = key
+                    moves = []
+                moves.append((raw_move, count))
+
+            if moves:
+                write_position()
+    except BaseException:
+        os.remove(temp_book)
+        raise
+
+    os.replace(temp_book, output_book)
+
+
+# Merge sorted polyglot books into one, summing the weights of each
+# (key, move). More than MERGE_FAN_IN books are first merged in passes
+# into temporary runs.
+def merge_books(book_files, output_book):
+    merged = []
+    sources = _reduce_sources(
+        [(path, _read_book) for path in book_files], MERGE_FAN_IN, None, merged
+    )
+    try:
+        write_merged_runs([read(path) for path, read in sources], output_book)
+    finally:
+        for path in set(merged + [path for path, _ in sources]) - set(book_files):
+            os.remove(path)
+
+
+# Collects the target player's opening moves for a polyglot opening book.
+# Move counts are kept in memory up to max_entries (key, move) pairs and
+# spilled to sorted temporary runs beyond that, so memory use does not grow
+# with the size of the input. max_entries=None keeps everything in memory.
+class OpeningBookBuilder:
+    def __init__(self, player_name, max_moves=10, max_entries=1000000):
+        self.player_name = player_name
+        self.max_moves = max_moves
+        self.max_entries = max_entries
+        self.counts = {}
+        self.run_files = []
+        self.run_dir = None
+
+    def start_game(self, game):
+        # Identify the target player (as White or Black)
+        self.is_white = game.headers.get("White") == self.player_name
+        self.is_black = game.headers.get("Black") == self.player_name
+        return self.is_white or self.is_black
+
+    def move(self, board, move, ply):
+        # Restrict to the first `max_moves` in the game
+        if ply > self.max_moves:
+            return
+
+        # Add the move only if it's played by the target player
+        if (self.is_white and board.turn) or (self.is_black and not board.turn):
+            self.add(chess.polyglot.zobrist_hash(board), polyglot_raw_move(board, move))
+
+    def end_game(self):
+        pass
+
+    def add(self, key, raw_move, count=1):
+        entry = (key, raw_move)
+        self.counts[entry] = self.counts.get(entry, 0) + count
+        if self.max_entries is not None and len(self.counts) >= self.max_entries:
+            self.spill()
+
+    # Add the move counts collected by another builder, e.g. a worker's
+    def merge(self, counts):
+        for (key, raw_move), count in counts.items():
+            self.add(key, raw_move, count)
+
+    # Write the in-memory counts to a sorted temporary run
+    def spill(self):
+        if not self.counts:
+            return
+        run_file = tempfile.NamedTemporaryFile(
+            prefix="book-run-", suffix=".bin", dir=self.run_dir, delete=False
+        )
+        with run_file:
+            _write_run(self.counts, run_file)
+        self.run_files.append(run_file.name)
+        self.counts = {}
+
+    # Merge every run file into a single one, MERGE_FAN_IN at a time.
+    # Returns the run files it replaced, for the caller to remove once
+    # nothing refers to them any more.
+    def compact_runs(self):
+        merged = []
+        sources = _reduce_sources(
+            [(path, _read_run) for path in self.run_files], 1, self.run_dir, merged
+        )
+        self.run_files = [path for path, _ in sources]
+        return merged
+
+    # Write the collected moves as a polyglot book, adding the weights of the
+    # given existing books (e.g. the previous version of output_book). Runs
+    # are merged in passes of at most MERGE_FAN_IN files. The run files are
+    # only removed once the book is written, so that a failed write can be
+    # retried or resumed from a checkpoint listing them.
+    def write(self, output_book, base_books=()):
+        in_memory = [
+            (key, raw_move, count) for (key, raw_move), count in sorted(self.counts.items())
+        ]
+        keep = set(base_books)
+        merged = []
+        sources = _reduce_sources(
+            [(path, _read_book) for path in base_books]
+            + [(path, _read_run) for path in self.run_files],
+            MERGE_FAN_IN - 1,
+            self.run_dir,
+            merged,
+        )
+        made_runs = set(merged + [path for path, _ in sources]) - keep - set(self.run_files)
+        try:
+            write_merged_runs([read(path) for path, read in sources] + [iter(in_memory)], output_book)
+        except BaseException:
+            for path in made_runs:
+                os.remove(path)
+            raise
+
+        for path in made_runs | set(self.run_files):
+            os.remove(path)
+        self.run_files = []
+
+        print(f"Polyglot book created: {output_book}")
+
+
+# Read-only view of a player's polyglot book for many fast lookups. The book
+# is memory-mapped and searched by binary search on the key; the entries of
+# recently looked up keys are kept in an LRU cache of cache_size keys.
+class PlayerBook:
+    def __init__(self, path, cache_size=4096):
+        self.file = open(path, "rb")
+        self.size = os.path.getsize(path) // ENTRY_STRUCT.size
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.find_entries = functools.lru_cache(maxsize=cache_size)(self._find_entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.size:
+            self.mmap.close()
+        self.file.close()
+
+    def _key_at(self, index):
+        return KEY_STRUCT.unpack_from(self.mmap, index * ENTRY_STRUCT.size)[0]
+
+    # Index of the first entry with a key not less than key in [lo, hi)
+    def _lower_bound(self, key, lo=0, hi=None):
+        if hi is None:
+            hi = self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _entries_from(self, key, index):
+        entries = []
+        while index < self.size:
+            entry_key, raw_move, weight, _ = ENTRY_STRUCT.unpack_from(
+                self.mmap, index * ENTRY_STRUCT.size
+            )
+            if entry_key != key:
+                break
+            entries.append((raw_move, weight))
+            index += 1
+        return tuple(entries)
+
+    def _find_entries(self, key):
+        return self._entries_from(key, self._lower_bound(key))
+
+    # Entries (raw_move, weight) of the given Zobrist keys. Keys are searched
+    # in sorted order, galloping forward from where the previous search
+    # ended, so nearby keys take only a few probes each.
+    def find_entries_many(self, keys):
+        found = {}
+        lo = 0
+        for key in sorted(set(keys)):
+            step = 1
+            hi = lo
+            while hi < self.size and self._key_at(hi) < key:
+                lo = hi + 1
+                hi += step
+                step *= 2
+            lo = self._lower_bound(key, lo, min(hi, self.size))
+            found[key] = self._entries_from(key, lo)
+        return [found[key] for key in keys]
+
+    # Weighted move distribution of a position: (move, probability) pairs by
+    # descending weight, empty when the position is not in the book
+    def move_distribution(self, board, entries=None):
+        if entries is None:
+            entries = self.find_entries(chess.polyglot.zobrist_hash(board))
+        total = sum(weight for _, weight in entries)
+        if not total:
+            return []
+        return [(decode_raw_move(board, raw_move), weight / total) for raw_move, weight in entries]
+
+    def move_distributions(self, boards):
+        keys = [chess.polyglot.zobrist_hash(board) for board in boards]
+        return [
+            self.move_distribution(board, entries)
+            for board, entries in zip(boards, self.find_entries_many(keys))
+        ]
+
+    def contains(self, board):
+        return bool(self.find_entries(chess.polyglot.zobrist_hash(board)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge polyglot opening books, summing the weights of identical entries")
+    parser.add_argument("output_book", type=str, help="The path to the merged book")
+    parser.add_argument("input_books", type=str, nargs="+", help="The paths to the books to merge")
+    args = parser.parse_args()
+
+    merge_books(args.input_books, args.output_book)
+    print(f"Polyglot book created: {args.output_book}")
@@ -0,0 +1,166 @@
+import chess
+import chess.pgn
+import csv
+import os
+import zlib
+
+
+# Headers stored for every game in the index
+INDEX_HEADERS = [
+    "White",
+    "Black",
+    "Result",
+    "TimeControl",
+    "WhiteElo",
+    "BlackElo",
+    "Date",
+    "Site",
+]
+
+
+# Path of the sidecar index file of a PGN file
+def index_file_for(pgn_file):
+    return pgn_file + ".idx"
+
+
+# Scan a PGN file's header sections only and return one entry per game with
+# its byte offset and the INDEX_HEADERS values ("" when a header is missing)
+def build_index(pgn_file):
+    entries = []
+    entry = None
+    offset = 0
+
+    with open(pgn_file, "rb") as pgn:
+        for line in pgn:
+            if line.startswith(b"[Event "):
+                entry = {"offset": offset}
+                entry.update((header, "") for header in INDEX_HEADERS)
+                entries.append(entry)
+            elif entry is not None and line.startswith(b"["):
+                match = chess.pgn.TAG_REGEX.match(line.decode("utf-8", "replace").strip())
+                if match and match.group(1) in INDEX_HEADERS:
+                    entry[match.group(1)] = match.group(2)
+            elif line.strip():
+                # Movetext reached, nothing more to read until the next game
+                entry = None
+            offset += len(line)
+
+    return entries
+
+
+# The index is written to a temporary file first, so that runs building it
+# at the same time (e.g. the shards of an extraction) never read it half written
+def write_index(entries, index_file):
+    temp_file = f"{index_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w", newline="") as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(["offset"] + INDEX_HEADERS)
+        for entry in entries:
+            csv_writer.writerow([entry["offset"]] + [entry[header] for header in INDEX_HEADERS])
+    os.replace(temp_file, index_file)
+
+
+def read_index(index_file):
+    entries = []
+    with open(index_file, newline="") as f:
+        for row in csv.DictReader(f):
+            row["offset"] = int(row["offset"])
+            entries.append(row)
+    return entries
+
+
+# Load the sidecar index of a PGN file, building and saving it first when it
+# is missing or older than the PGN file
+def load_index(pgn_file):
+    index_file = index_file_for(pgn_file)
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(pgn_file):
+        return read_index(index_file)
+
+    entries = build_index(pgn_file)
+    write_index(entries, index_file)
+    return entries
+
+
+# Player name of a White/Black header, without anything after a comma
+def _player_name(header):
+    return header.split(",")[0]
+
+
+def _elo(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+# Function to check if an indexed game passes the given filters. Every filter
+# left as None is ignored; dates use the PGN "YYYY.MM.DD" format and the
+# rating range applies to both players.
+def game_matches(
+    entry,
+    player_name=None,
+    min_elo=None,
+    max_elo=None,
+    time_controls=None,
+    date_from=None,
+    date_to=None,
+):
+    if player_name is not None and player_name not in (
+        _player_name(entry["White"]),
+        _player_name(entry["Black"]),
+    ):
+        return False
+
+    if min_elo is not None or max_elo is not None:
+        for elo in (_elo(entry["WhiteElo"]), _elo(entry["BlackElo"])):
+            if elo is None:
+                return False
+            if min_elo is not None and elo < min_elo:
+                return False
+            if max_elo is not None and elo > max_elo:
+                return False
+
+    if time_controls is not None and entry["TimeControl"] not in time_controls:
+        return False
+
+    if date_from is not None and not date_from <= entry["Date"]:
+        return False
+    if date_to is not None and not entry["Date"] <= date_to:
+        return False
+
+    return True
+
+
+def filter_index(entries, **filters):
+    return [entry for entry in entries if game_matches(entry, **filters)]
+
+
+# Entries of shard `shard` out of num_of_shards. By "index" each shard
+# gets a contiguous range of games, so the shards in order hold the games in
+# file order; by "site" a game goes to the shard its Site header hashes to,
+# whatever the rest of the file holds. Either way every game is in exactly
+# one shard, the same one on every machine.
+def shard_entries(entries, shard, num_of_shards, by="index"):
+    if by == "site":
+        return [
+            entry
+            for entry in entries
+            if zlib.crc32(entry["Site"].encode()) % num_of_shards == shard
+        ]
+    num_of_games = len(entries)
+    return entries[shard * num_of_games // num_of_shards : (shard + 1) * num_of_games // num_of_shards]
+
+
+# Find a game by its Site header, either the full URL or the game id at its end
+def find_game(entries, site):
+    sites = {}
+    for entry in entries:
+        sites.setdefault(entry["Site"], entry)
+        sites.setdefault(entry["Site"].rsplit("/", 1)[-1], entry)
+    return sites.get(site)
+
+
+# Read the game starting at a byte offset of an open PGN file
+def read_game_at(pgn, offset):
+    pgn.seek(offset)
+    return chess.pgn.read_game(pgn)
@@ -0,0 +1,111 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Decompressors of the supported compressed PGN files, by extension
+COMPRESSED_OPENERS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+}
+if zstandard is not None:
+    COMPRESSED_OPENERS[".zst"] = lambda path: zstandard.ZstdDecompressor().stream_reader(
+        open(path, "rb"), closefd=True
+    )
+
+COMPRESSED_EXTENSIONS = [".gz", ".bz2", ".xz", ".zst"]
+
+
+def is_compressed(path):
+    return os.path.splitext(path)[1] in COMPRESSED_EXTENSIONS
+
+
+# File name without the compression extension, e.g. Adam05.pgn for Adam05.pgn.gz
+def strip_compression_extension(path):
+    if is_compressed(path):
+        return os.path.splitext(path)[0]
+    return path
+
+
+# Binary stream reading the output of a decompressor that runs in a
+# background thread. The thread keeps at most max_chunks chunks of
+# chunk_size bytes ahead of the reader, so decompression overlaps with
+# parsing without buffering the whole file.
+class ThreadedReader(io.RawIOBase):
+    def __init__(self, raw, chunk_size=1 << 20, max_chunks=8):
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.chunk = b""
+        self.chunk_pos = 0
+        self.finished = False
+        self.stopping = False
+        self.thread = threading.Thread(target=self._decompress, daemon=True)
+        self.thread.start()
+
+    def _decompress(self):
+        try:
+            while not self.stopping:
+                data = self.raw.read(self.chunk_size)
+                self.chunks.put(data)
+                if not data:
+                    break
+        except Exception as error:
+            self.chunks.put(error)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.chunk_pos >= len(self.chunk):
+            if self.finished:
+                return 0
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                self.finished = True
+                return 0
+            self.chunk = chunk
+            self.chunk_pos = 0
+
+        size = min(len(buffer), len(self.chunk) - self.chunk_pos)
+        buffer[:size] = self.chunk[self.chunk_pos : self.chunk_pos + size]
+        self.chunk_pos += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            # Unblock the thread if it waits on a full queue, then let it stop
+            self.stopping = True
+            while self.thread.is_alive():
+                try:
+                    self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.raw.close()
+        super().close()
+
+
+# Open a PGN file for reading as text, decompressing .gz, .bz2, .xz and
+# (with the zstandard module installed) .zst files in a background thread
+def open_pgn(path):
+    extension = os.path.splitext(path)[1]
+    if extension not in COMPRESSED_EXTENSIONS:
+        return open(path)
+
+    if extension not in COMPRESSED_OPENERS:
+        raise ValueError(f"Reading {extension} files needs the zstandard module")
+
+    reader = ThreadedReader(COMPRESSED_OPENERS[extension](path))
+    return io.TextIOWrapper(io.BufferedReader(reader))
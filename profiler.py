@@ -0,0 +1,124 @@
+import json
+import time
+
+
+# Durations are counted in log-scaled buckets of 8 per power of two rather
+# than kept one by one, so memory stays constant however many calls are
+# timed and percentiles are exact to within 1/8
+def _bucket(elapsed_ns):
+    shift = max(0, elapsed_ns.bit_length() - 4)
+    return (shift << 4) | (elapsed_ns >> shift)
+
+
+# Largest duration that falls into a bucket
+def _bucket_upper_bound(bucket):
+    shift = bucket >> 4
+    return (((bucket & 0xF) + 1) << shift) - 1
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.histogram = {}
+
+    def add(self, elapsed_ns):
+        self.calls += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+        bucket = _bucket(elapsed_ns)
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def percentile_ns(self, fraction):
+        needed = fraction * self.calls
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= needed:
+                return min(_bucket_upper_bound(bucket), self.max_ns)
+        return self.max_ns
+
+    def summary(self):
+        return {
+            "total_sec": self.total_ns / 1e9,
+            "calls": self.calls,
+            "mean_us": self.total_ns / self.calls / 1e3 if self.calls else 0.0,
+            "p99_us": self.percentile_ns(0.99) / 1e3,
+        }
+
+
+# Times named stages of an extraction. Functions are instrumented by
+# replacing them in their module (or on their object) with a timing
+# wrapper, so nothing changes in the hot path unless profiling is on.
+# Stage times are inclusive: a stage calling another one counts its time.
+class Profiler:
+    def __init__(self):
+        self.stages = {}
+        self.patched = []
+        self.start = time.perf_counter()
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    # Wrap function so that every call is timed as stage name
+    def timed(self, name, function):
+        add = self.stage(name).add
+        perf_counter_ns = time.perf_counter_ns
+
+        def timed_function(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add(perf_counter_ns() - start)
+
+        return timed_function
+
+    # Replace attributes of a module or object by timed wrappers; stages
+    # maps stage names to attribute names
+    def instrument(self, target, stages):
+        for name, attribute in stages.items():
+            function = getattr(target, attribute)
+            self.patched.append((target, attribute, function))
+            setattr(target, attribute, self.timed(name, function))
+
+    # Put back every instrumented function
+    def restore(self):
+        for target, attribute, function in reversed(self.patched):
+            setattr(target, attribute, function)
+        self.patched = []
+
+    def summary(self):
+        return {
+            "wall_sec": time.perf_counter() - self.start,
+            "stages": {
+                name: stats.summary() for name, stats in sorted(self.stages.items()) if stats.calls
+            },
+        }
+
+    def format_table(self):
+        summary = self.summary()
+        lines = [f"{'stage':32} {'total s':>10} {'calls':>10} {'mean us':>10} {'p99 us':>10}"]
+        for name, stats in summary["stages"].items():
+            lines.append(
+                f"{name:32} {stats['total_sec']:10.3f} {stats['calls']:10d} "
+                f"{stats['mean_us']:10.2f} {stats['p99_us']:10.2f}"
+            )
+        lines.append(f"{'wall time':32} {summary['wall_sec']:10.3f}")
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+# Writer forwarding rows to another writer (e.g. a csv.writer, whose
+# methods cannot be replaced), timing every write
+class TimedWriter:
+    def __init__(self, writer, profiler, name="write"):
+        self.writerow = profiler.timed(name, writer.writerow)
+        self.writerows = profiler.timed(name, writer.writerows)
@@ -0,0 +1,165 @@
+import array
+import json
+import os
+
+import chess
+
+from columnar_output import encode_move
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+SCHEMA_FILE = "schema.json"
+
+# Order of the 12 piece planes: white pawn to king, then black pawn to king
+PLANE_PIECES = [
+    (color, piece_type)
+    for color in [chess.WHITE, chess.BLACK]
+    for piece_type in chess.PIECE_TYPES
+]
+
+# Castling rights columns, as the rook square each right refers to
+CASTLING_SQUARES = [chess.BB_H1, chess.BB_A1, chess.BB_H8, chess.BB_A8]
+
+# Arrays of every shard, with their numpy dtype. Position arrays have one
+# entry per position, move arrays one per candidate move; move_position is
+# the index of the move's position within the shard.
+POSITION_ARRAYS = {
+    "planes": "u1",
+    "side_to_move": "u1",
+    "castling": "u1",
+    "en_passant": "i1",
+    "is_white_player": "u1",
+}
+MOVE_ARRAYS = {
+    "move_position": "i4",
+    "move": "u2",
+    "label": "u1",
+}
+
+
+def shard_file(directory, name, shard):
+    return os.path.join(directory, f"{name}-{shard:05d}.npy")
+
+
+# Writes positions as board tensors in .npy shards of shard_size positions
+# that training can memory-map: 12x64 piece occupancy planes, side to move,
+# castling rights and en passant square, plus the encoded candidate moves
+# of every position with their labels. Positions are buffered as bitboards
+# and turned into planes with numpy a shard at a time. Needs numpy (see
+# requirements-optional.txt).
+class TensorWriter:
+    def __init__(self, directory, shard_size=65536):
+        if numpy is None:
+            raise ImportError("Writing board tensors needs numpy")
+        self.np = numpy
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.shards = []
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _reset(self):
+        self.bitboards = array.array("Q")
+        self.side_to_move = array.array("B")
+        self.castling = array.array("B")
+        self.en_passant = array.array("b")
+        self.is_white_player = array.array("B")
+        self.move_position = array.array("i")
+        self.moves = array.array("H")
+        self.labels = array.array("B")
+        self.num_of_positions = 0
+
+    def add_position(self, board, is_white_player, legal_moves, played_move):
+        for color, piece_type in PLANE_PIECES:
+            self.bitboards.append(board.pieces_mask(piece_type, color))
+        self.side_to_move.append(1 if board.turn else 0)
+        castling_rights = board.clean_castling_rights()
+        for rook_square in CASTLING_SQUARES:
+            self.castling.append(1 if castling_rights & rook_square else 0)
+
+        # The en passant square only counts when a capture on it is legal,
+        # as in the FEN and the Zobrist hash
+        if board.ep_square is not None and board.has_legal_en_passant():
+            self.en_passant.append(board.ep_square)
+        else:
+            self.en_passant.append(-1)
+        self.is_white_player.append(1 if is_white_player else 0)
+
+        position = self.num_of_positions
+        for legal_move in legal_moves:
+            self.move_position.append(position)
+            self.moves.append(encode_move(legal_move))
+            self.labels.append(1 if legal_move == played_move else 0)
+
+        self.num_of_positions += 1
+        if self.num_of_positions >= self.shard_size:
+            self.flush()
+
+    # Write the buffered positions as the next shard
+    def flush(self):
+        if not self.num_of_positions:
+            return
+        np = self.np
+        num_of_positions = self.num_of_positions
+
+        # Little-endian bytes of every bitboard, unpacked to one byte per
+        # square in square order (a1 = 0, h8 = 63)
+        bitboards = np.frombuffer(self.bitboards, dtype=np.uint64).astype("<u8")
+        planes = np.unpackbits(
+            bitboards.view(np.uint8).reshape(num_of_positions, 12, 8), axis=2, bitorder="little"
+        )
+
+        shard = len(self.shards)
+        arrays = {
+            "planes": planes,
+            "side_to_move": np.frombuffer(self.side_to_move, dtype=np.uint8),
+            "castling": np.frombuffer(self.castling, dtype=np.uint8).reshape(num_of_positions, 4),
+            "en_passant": np.frombuffer(self.en_passant, dtype=np.int8),
+            "is_white_player": np.frombuffer(self.is_white_player, dtype=np.uint8),
+            "move_position": np.frombuffer(self.move_position, dtype=np.int32).astype("<i4"),
+            "move": np.frombuffer(self.moves, dtype=np.uint16).astype("<u2"),
+            "label": np.frombuffer(self.labels, dtype=np.uint8),
+        }
+        for name, values in arrays.items():
+            np.save(shard_file(self.directory, name, shard), values)
+
+        self.shards.append({"positions": num_of_positions, "moves": len(self.moves)})
+        self._reset()
+
+    def close(self):
+        self.flush()
+        schema = {
+            "shard_size": self.shard_size,
+            "shards": self.shards,
+            "position_arrays": POSITION_ARRAYS,
+            "move_arrays": MOVE_ARRAYS,
+            "plane_order": [
+                chess.piece_symbol(piece_type).upper() if color else chess.piece_symbol(piece_type)
+                for color, piece_type in PLANE_PIECES
+            ],
+            "castling_order": ["white_kingside", "white_queenside", "black_kingside", "black_queenside"],
+            "move_encoding": "from_square | to_square << 6 | promotion_piece_type << 12",
+        }
+        with open(os.path.join(self.directory, SCHEMA_FILE), "w") as f:
+            json.dump(schema, f, indent=2)
+
+
+# Memory-map the arrays of one shard of a tensor output directory. Needs
+# numpy (see requirements-optional.txt).
+def load_tensor_shard(directory, shard):
+    if numpy is None:
+        raise ImportError("Loading board tensors needs numpy")
+    return {
+        name: numpy.load(shard_file(directory, name, shard), mmap_mode="r")
+        for name in list(POSITION_ARRAYS) + list(MOVE_ARRAYS)
+    }
@@ -0,0 +1,222 @@
+import os
+import sys
+
+import chess
+import chess.pgn
+import pytest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+import extract_features
+from extract_features import FEATURE_NAMES, extract_all
+
+
+PGN_FILE = os.path.join(REPO_DIR, "Adam05.pgn")
+
+
+# The functions below are copies of the square-by-square versions of
+# extract_features.py from before the attack map, kept here so that the
+# columns extract_all computes from the attack map are checked against
+# is_attacked_by and legal_moves rather than against the attack map itself
+
+
+# Function to calculate control over central squares
+def center_control(board, is_white_player):
+    central_squares = [chess.E4, chess.D4, chess.E5, chess.D5]
+    player_control = 0
+
+    for square in central_squares:
+        if is_white_player:
+            # Add 1 for each square attacked by white
+            if board.is_attacked_by(chess.WHITE, square):
+                player_control += 1
+        else:
+            # Add 1 for each square attacked by black
+            if board.is_attacked_by(chess.BLACK, square):
+                player_control += 1
+
+    return player_control
+
+
+# Function to calculate the total number of legal moves for all pieces
+def piece_mobility(board):
+    white_mobility = 0
+    black_mobility = 0
+
+    for move in board.legal_moves:
+        piece = board.piece_at(move.from_square)
+        if piece and piece.piece_type != chess.PAWN:
+            if piece.color == chess.WHITE:
+                white_mobility += 1
+            else:
+                black_mobility += 1
+
+    return {
+        "white_piece_mobility": white_mobility,
+        "black_piece_mobility": black_mobility,
+    }
+
+
+# Function to calculate the number of pieces actively attacking opponent squares
+def piece_activity(board):
+    white_activity = 0
+    black_activity = 0
+
+    # Iterate through pieces on the board
+    for square, piece in board.piece_map().items():
+        if piece.piece_type == chess.PAWN:  # Exclude pawns
+            continue
+
+        if piece.color == chess.WHITE:
+            # Check if the piece is attacking any black pieces
+            if any(
+                board.is_attacked_by(chess.BLACK, move.to_square)
+                for move in board.legal_moves
+                if move.from_square == square
+            ):
+                white_activity += 1
+        else:
+            # Check if the piece is attacking any white pieces
+            if any(
+                board.is_attacked_by(chess.WHITE, move.to_square)
+                for move in board.legal_moves
+                if move.from_square == square
+            ):
+                black_activity += 1
+
+    return {
+        "white_piece_activity": white_activity,
+        "black_piece_activity": black_activity,
+    }
+
+
+# Function to calculate the number of pieces attacking opponent pieces
+def threats(board):
+    white_attacking = 0
+    black_attacking = 0
+    white_hanging = 0
+    black_hanging = 0
+
+    # Iterate over pieces on the board
+    for square, piece in board.piece_map().items():
+        if piece.piece_type == chess.PAWN:  # Exclude pawns
+            continue
+
+        if piece.color == chess.WHITE:
+            # Count attacking pieces
+            if board.is_attacked_by(chess.BLACK, square):
+                white_attacking += 1
+            # Count hanging pieces
+            if not board.is_attacked_by(chess.WHITE, square):
+                white_hanging += 1
+
+        elif piece.color == chess.BLACK:
+            # Count attacking pieces
+            if board.is_attacked_by(chess.WHITE, square):
+                black_attacking += 1
+            # Count hanging pieces
+            if not board.is_attacked_by(chess.BLACK, square):
+                black_hanging += 1
+
+    return {
+        "white_attacking_pieces": white_attacking,
+        "black_attacking_pieces": black_attacking,
+        "white_hanging_pieces": white_hanging,
+        "black_hanging_pieces": black_hanging,
+    }
+
+
+# Function to calculate space advantage (total squares controlled in opponent's territory)
+def space_advantage(board, is_white):
+    controlled_squares = 0
+
+    # Define the range of squares that represent the opponent's territory
+    opponent_territory_start = 32  # For black: 32 to 63; for white: 0 to 31
+    opponent_territory_end = 64 if is_white else 32
+
+    # Iterate over the squares in the opponent's territory
+    for square in range(opponent_territory_start, opponent_territory_end):
+        if is_white:  # Calculate for white's advantage
+            if board.is_attacked_by(chess.WHITE, square):
+                controlled_squares += 1
+            if board.is_attacked_by(chess.BLACK, square):
+                controlled_squares -= 1
+        else:  # Calculate for black's advantage
+            if board.is_attacked_by(chess.BLACK, square):
+                controlled_squares += 1
+            if board.is_attacked_by(chess.WHITE, square):
+                controlled_squares -= 1
+
+    return controlled_squares
+
+
+# Columns computed one by one with the square-by-square functions
+def legacy_features(board, is_white_player):
+    material = extract_features.material_balance(board)
+    king_safety = extract_features.king_safety(board)
+    pawn_structure = extract_features.pawn_structure(board)
+    semi_open_files = extract_features.semi_open_files(board)
+    piece_mobility_values = piece_mobility(board)
+    piece_activity_values = piece_activity(board)
+    king_activity = extract_features.king_activity_endgame(board)
+    threats_values = threats(board)
+    bishop_pair = extract_features.bishop_pair(board)
+    pawn_majority = extract_features.pawn_majority(board)
+
+    return {
+        "white_material_balance": material["white_material"],
+        "black_material_balance": material["black_material"],
+        "material_imbalance": extract_features.material_imbalance(board),
+        "minor_piece_imbalance": extract_features.minor_piece_imbalance(board),
+        **king_safety,
+        **pawn_structure,
+        "center_control": center_control(board, is_white_player),
+        "open_files": extract_features.open_files(board),
+        **semi_open_files,
+        **piece_mobility_values,
+        **piece_activity_values,
+        **king_activity,
+        **threats_values,
+        "player_space_advantage": space_advantage(board, is_white_player),
+        **bishop_pair,
+        "player_knight_outposts": extract_features.knight_outposts(board, is_white_player),
+        "rook_on_seventh_rank": extract_features.rook_on_seventh_rank(board),
+        **pawn_majority,
+        "player_passed_pawn_advancement": extract_features.passed_pawn_advancement(
+            board, is_white_player
+        ),
+    }
+
+
+# Every position of every game in Adam05.pgn, before each move
+@pytest.fixture(scope="module")
+def boards():
+    boards = []
+    with open(PGN_FILE) as pgn:
+        while True:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            board = game.board()
+            for move in game.mainline_moves():
+                boards.append(board.copy(stack=False))
+                board.push(move)
+    return boards
+
+
+def test_legacy_functions_cover_every_column(boards):
+    assert sorted(legacy_features(boards[0], True)) == sorted(FEATURE_NAMES)
+
+
+@pytest.mark.parametrize("is_white_player", [True, False], ids=["white", "black"])
+def test_extract_all_matches_legacy_functions(boards, is_white_player):
+    for board in boards:
+        expected = legacy_features(board, is_white_player)
+        values = extract_all(board, is_white_player)
+        mismatches = [
+            (name, expected[name], values[name])
+            for name in FEATURE_NAMES
+            if expected[name] != values[name] or type(expected[name]) is not type(values[name])
+        ]
+        assert not mismatches, f"{board.fen()}: {mismatches}"
@@ -0,0 +1,24 @@
+import chess
+
+
+# Board of a FEN (the starting position by default) followed by moves in
+# UCI notation. Raises ValueError on an invalid FEN or move, or on a FEN
+# python-chess parses but that is not a legal position (e.g. a missing
+# king), which the features cannot be computed for.
+def board_from_request(fen=None, moves=()):
+    board = chess.Board(fen) if fen else chess.Board()
+    status = board.status()
+    if status:
+        problems = [flag.name.lower().replace("_", " ") for flag in chess.Status if flag & status]
+        raise ValueError(", ".join(problems))
+    for move in moves:
+        board.push_uci(move)
+    return board
+
+
+# Board of the arguments of a UCI position command:
+# startpos | fen <fen>, then optionally moves <move>...
+def board_from_uci_position(arguments):
+    moves = arguments.index("moves") if "moves" in arguments else len(arguments)
+    fen = " ".join(arguments[1:moves]) if arguments[:1] == ["fen"] else None
+    return board_from_request(fen, arguments[moves + 1:])